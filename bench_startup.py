@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""Startup benchmark for bookdesc command line.
+
+Runs bookdesc with the given arguments (--version by default) under
+python -X importtime several times and prints the slowest imports and the
+wall time over a bare interpreter start. Exits with 1 if the median extra
+time is above the target.
+
+Usage: bench_startup.py [--runs N] [--target MS] [-- bookdesc args]
+"""
+
+import argparse
+import os.path
+import statistics
+import subprocess
+import sys
+import time
+
+_BOOKDESC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "bookdesc.py")
+
+def _run(args):
+    "Run python with args, return (wall seconds, stderr)"
+    start = time.perf_counter()
+    done = subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    return time.perf_counter() - start, done.stderr
+
+def _imports(importtime_output):
+    "Parse -X importtime output into list of (self us, cumulative us, name)"
+    result = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"): continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit(): continue # header
+        result.append((int(fields[0]), int(fields[1]), fields[2].strip()))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="bookdesc startup benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--target", type=float, default=50,
+        help="target for extra startup time, ms (default: 50)")
+    parser.add_argument("--top", type=int, default=10,
+        help="number of slowest imports to show (default: 10)")
+    parser.add_argument("args", nargs="*", default=["--version"])
+    args = parser.parse_args()
+
+    bare = []
+    extra = []
+    for _ in range(args.runs):
+        bare.append(_run(["-c", "pass"])[0])
+        wall, _ = _run([_BOOKDESC] + args.args)
+        extra.append(wall - bare[-1])
+    _, output = _run(["-X", "importtime", _BOOKDESC] + args.args)
+    imports = _imports(output)
+    baseline = set(name for _, _, name in
+        _imports(_run(["-X", "importtime", "-c", "pass"])[1]))
+
+    print("Slowest imports (cumulative, us):")
+    top = sorted((i for i in imports if i[2].strip() not in baseline),
+        key=lambda i: i[1], reverse=True)
+    for self_us, cumulative_us, name in top[:args.top]:
+        print("%10d %10d  %s" % (cumulative_us, self_us, name))
+    print("Modules imported: %d (bare interpreter: %d)" %
+        (len(imports), len(baseline)))
+    median_ms = statistics.median(extra) * 1000
+    print("Bare interpreter: %.1f ms, bookdesc %s: +%.1f ms (target %.0f ms)" %
+        (statistics.median(bare) * 1000, " ".join(args.args), median_ms,
+         args.target))
+    return 0 if median_ms <= args.target else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
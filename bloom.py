@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+"""Bloom filter for sha1 existence checks.
+
+Answers "definitely not added" or "maybe added" from memory. The filter grows
+by adding layers twice as large as the previous one, each with half the false
+positive rate, so the total rate stays below error_rate however many keys are
+added. Filters are pickleable."""
+
+import hashlib
+import math
+
+_LN2 = math.log(2)
+
+class _Layer:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        bits = max(8, int(-capacity * math.log(error_rate) / (_LN2 * _LN2)))
+        self.size = bits
+        self.hashes = max(1, round(bits / capacity * _LN2))
+        self.bits = bytearray((bits + 7) // 8)
+
+    def positions(self, h1, h2):
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, h1, h2):
+        for pos in self.positions(h1, h2):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, hashes):
+        h1, h2 = hashes
+        for pos in self.positions(h1, h2):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)): return False
+        return True
+
+class BloomFilter:
+    def __init__(self, capacity=16384, error_rate=0.01):
+        """@param capacity Number of keys for the first layer
+           @param error_rate Upper bound of false positive rate"""
+        assert capacity > 0
+        assert 0 < error_rate < 1
+        self._layers = [_Layer(capacity, error_rate / 2)]
+
+    def add(self, key):
+        "Add bytes key to the filter"
+        layer = self._layers[-1]
+        if layer.count >= layer.capacity:
+            layer = _Layer(layer.capacity * 2, layer.error_rate / 2)
+            self._layers.append(layer)
+        layer.add(*_hashes(key))
+
+    def __contains__(self, key):
+        hashes = _hashes(key)
+        for layer in self._layers:
+            if hashes in layer: return True
+        return False
+
+    def __len__(self):
+        "Number of keys added"
+        return sum(layer.count for layer in self._layers)
+
+def _hashes(key):
+    "Two independent hashes for double hashing (Kirsch-Mitzenmacher)"
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), \
+        int.from_bytes(digest[8:], "little") | 1
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import bloom
+import pickle
+import unittest
+
+class BloomFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.fixture = bloom.BloomFilter(capacity=100)
+        self.keys = [i.to_bytes(20, "big") for i in range(1000)]
+
+    def test_empty(self):
+        self.assertFalse(b'01' in self.fixture)
+        self.assertEqual(0, len(self.fixture))
+
+    def test_no_false_negatives(self):
+        for key in self.keys:
+            self.fixture.add(key)
+        self.assertEqual(1000, len(self.fixture))
+        for key in self.keys:
+            self.assertTrue(key in self.fixture)
+
+    def test_false_positive_rate(self):
+        for key in self.keys:
+            self.fixture.add(key)
+        others = [i.to_bytes(20, "little") for i in range(1, 10001)]
+        false_positives = sum(1 for key in others if key in self.fixture)
+        self.assertLess(false_positives, 200)
+
+    def test_pickle(self):
+        self.fixture.add(b'01')
+        restored = pickle.loads(pickle.dumps(self.fixture))
+        self.assertTrue(b'01' in restored)
+        self.assertFalse(b'02' in restored)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,11 +9,13 @@ class Book:
         self.year = None
         self.isbn = None
         self.metatext = None
+        self.duplicates = [] # other paths of the same file, index only
 
 class File:
     def __init__(self):
         self.path = None
         self.sha1 = None
         self.md5 = None
+        self.sha256 = None # only computed on request
         self.size = None
         self.mod_time = 0 # Unix seconds
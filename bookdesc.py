@@ -40,40 +40,85 @@ h1. Non-goals
 
 VERSION=1.5
 
-import gzip
-import csv
-import keyvalue
 import argparse
+import collections
+import csv
+import functools
+import itertools
 import os
 import os.path
+import signal
 import sys
 
 import log
-import csv_parser
-import csv_manager
-import sources
-import fb2_parser
-import i18n
+
+# Our other modules, asyncio and concurrent.futures are imported where they
+# are needed: bookdesc is often started once per file (or just for -V), and
+# parsers, CSV manager and index backends take much longer to import than to
+# print the version
 
 _LOGGER = log.get("bookdesc")
 
+# Files with these extensions are sniffed for FB2 contents, others are 
+# skipped without opening
+_CANDIDATE_EXTS = (".fb2", ".xml", "")
+
+_DEFAULT_BUFFER_SIZE = 1024*1024
+
+# Archives with fewer members are not worth spawning workers for
+_MIN_PARALLEL_MEMBERS = 16
+
+# Files in a folder hinted to the OS to be read ahead of parsing
+_READAHEAD_FILES = 4
+
+# Files read at once by parse_inputs_async()
+_DEFAULT_OPENS = 8
+
+# Each worker gets several smaller slices of namelist() rather than one big
+# slice, so a worker stuck on large books does not hold up the whole archive
+_SLICES_PER_JOB = 4
+
 class BookDesc:
     "Frontend class for the entire library"
     
-    def __init__(self, outpath, dumb, idx_backend=keyvalue.open):
+    def __init__(self, outpath, dumb, idx_backend=None, jobs=1,
+                       buffer_size=_DEFAULT_BUFFER_SIZE, sha256=False,
+                       csv_format="gzip", offsets=False):
+        """@param idx_backend Index backend factory, keyvalue.open by default
+           @param jobs Number of worker processes used to parse members of
+                  a single .zip archive in parallel (1 means no workers)
+           @param buffer_size Size of the read buffer in bytes (at least 1Mb)
+           @param sha256 Compute SHA-256 of books and write it to CSVs
+           @param csv_format One of csv_manager.formats()
+           @param offsets Write .offsets tables next to CSVs (not in dumb
+                  mode, since dumb CSVs are not sorted)"""
+        import csv_manager
         self._dumb = dumb
+        self._jobs = max(1, jobs)
+        self._pool = None
+        self._sha256 = sha256
         if self._dumb:
-            self._output = gzip.open(outpath, "wt")
+            import csv_parser
+            self._output = csv_manager.open_csv(outpath, "wt", csv_format)
             self._writer = csv.writer(self._output, quoting=csv.QUOTE_MINIMAL)
-            self._writer.writerow(csv_parser.CSV_HEADER)
+            self._writer.writerow(csv_parser.header(sha256))
             _LOGGER.debug("Created CSV at %s", outpath)
         else:
+            if idx_backend is None:
+                import keyvalue
+                idx_backend = keyvalue.open
             self._manager = csv_manager.Manager(outpath, 
-                idx_backend=idx_backend)
+                idx_backend=idx_backend, sha256=sha256, 
+                csv_format=csv_format, offsets=offsets)
             _LOGGER.debug("Initialized Manager at %s", outpath)
-        self._parse_buffer = bytearray(1024*1024)
+        # books already in the indexes are not parsed again
+        self._known = None if self._dumb else self._find_known
+        self._parse_buffer = bytearray(buffer_size)
 
     def close(self):
+        if self._pool:
+            self._pool.shutdown()
+            self._pool = None
         if self._dumb:
             self._output.close()
         else:
@@ -84,6 +129,7 @@ class BookDesc:
 
     def parse_inputs(self, *inputs):
         "Parse inputs(sequence of strings), only parse .fb2 srcs"
+        import sources
         for input in inputs:
             src_or_srcs = sources.source_at(input)
             if src_or_srcs:
@@ -91,48 +137,185 @@ class BookDesc:
             else:
                 _LOGGER.warning("Input %s cannot be recognized", input)
 
+    async def parse_inputs_async(self, *inputs, opens=_DEFAULT_OPENS):
+        """Like parse_inputs(), but FB2 files (plain or compressed) are read
+           into memory by a pool of opens threads, so many reads are in 
+           flight on storage with high latency per request (NFS). Books are
+           still parsed one at a time, from memory, in the calling thread. 
+           Archives are parsed as in parse()"""
+        import asyncio
+        import concurrent.futures
+        loop = asyncio.get_running_loop()
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(opens) as pool:
+            for src in self._prefetchable(inputs):
+                pending.add(loop.run_in_executor(pool, _prefetch, src))
+                # at most that many files are kept in memory
+                if len(pending) >= 2*opens:
+                    done, pending = await asyncio.wait(pending, 
+                        return_when=asyncio.FIRST_COMPLETED)
+                    self._parse_prefetched(done)
+            while pending:
+                done, pending = await asyncio.wait(pending, 
+                    return_when=asyncio.FIRST_COMPLETED)
+                self._parse_prefetched(done)
+
+    def _prefetchable(self, inputs):
+        """Yield files from inputs which may be FB2s, parse everything else
+           (archives) right away"""
+        import sources
+        for input in inputs:
+            src_or_srcs = sources.source_at(input)
+            if not src_or_srcs:
+                _LOGGER.warning("Input %s cannot be recognized", input)
+            else:
+                yield from self._prefetchable_in(src_or_srcs)
+
+    def _prefetchable_in(self, src_or_srcs):
+        import sources
+        if isinstance(src_or_srcs, sources.DirectorySources):
+            for src in src_or_srcs.sources():
+                if src: yield from self._prefetchable_in(src)
+        elif isinstance(src_or_srcs, (sources.FileSource, 
+                sources.CompressedFileSource)):
+            if _is_fb2(src_or_srcs): yield src_or_srcs
+        else:
+            self.parse(src_or_srcs)
+
+    def _parse_prefetched(self, futures):
+        for future in futures:
+            src = future.result()
+            if src: self.parse_fb2(src)
+
     def parse(self, src_or_srcs):
         "Parse all FB2 file from src or srcs"
+        import sources
         _LOGGER.debug("Scanning %s", src_or_srcs)
         if isinstance(src_or_srcs, sources.Sources):
             srcs = src_or_srcs
             _LOGGER.debug("Found Sources %s", srcs)
             try:
-                for src in srcs.sources():
-                    self.parse(src)
+                if self._jobs > 1 and \
+                        isinstance(srcs, sources.ZipFileListing) and \
+                        srcs.reopenable():
+                    self._parse_zip_parallel(srcs)
+                elif isinstance(srcs, sources.DirectorySources):
+                    for src in _readahead(srcs.sources(), _READAHEAD_FILES):
+                        self.parse(src)
+                else:
+                    for src in srcs.sources():
+                        self.parse(src)
             finally:
                 srcs.close()
         elif isinstance(src_or_srcs, sources.Source):
             src = src_or_srcs
-            _, ext = os.path.splitext(src.path())
-            ext = ext.strip().lower()
-            if ext == ".fb2":
+            if _is_fb2(src):
                 self.parse_fb2(src)
         else: assert src_or_srcs is None, "Got unknown src: "\
                     + str(src_or_srcs)
 
     def parse_fb2(self, fb2_src):
         "Parse src which MUST be an FB2 file"
-        _LOGGER.info("Parsing %s", fb2_src)
-        with fb2_src.open("rb") as stream:
-            book = None
-            try:
-                book = fb2_parser.parse(stream, buffer=self._parse_buffer)
-                book.file.path = fb2_src.path()
-                book.file.mod_time = fb2_src.mtime()
-                book.file.size = fb2_src.size()
-            except:
-                _LOGGER.exception("FB2 '%s' could not be parsed", fb2_src)
-                book = None
-            if book: 
-                _LOGGER.info("Found book '%s'", book.name)
-                if self._dumb:
-                    row = csv_parser.to_row(book)
-                    self._writer.writerow(row)
-                else:
-                    self._manager.put(book)
-            else:
-                _LOGGER.warning("Couldn't parse book %s", fb2_src)
+        book = _parse_book(fb2_src, self._parse_buffer, self._sha256,
+            self._known)
+        if book: self._store(book)
+
+    def _find_known(self, sha1):
+        book = self._manager.find(sha1)
+        if book: book.duplicates = []
+        return book
+
+    def _store(self, book):
+        _LOGGER.info("Found book '%s'", book.name)
+        if self._dumb:
+            import csv_parser
+            row = csv_parser.to_row(book, self._sha256)
+            self._writer.writerow(row)
+        else:
+            self._manager.put(book)
+
+    def _parse_zip_parallel(self, listing):
+        """Split members of the .zip between worker processes. Every worker
+           opens the archive by path, so members are inflated, hashed and
+           parsed concurrently. Books are stored here, in this process"""
+        names = listing.namelist()
+        if len(names) < _MIN_PARALLEL_MEMBERS:
+            for src in listing.sources():
+                self.parse(src)
+            return
+        _LOGGER.debug("Parsing %d members of %s using %d workers", 
+            len(names), listing, self._jobs)
+        slices = _split(names, self._jobs * _SLICES_PER_JOB)
+        paths = itertools.repeat(listing.path())
+        buffer_sizes = itertools.repeat(len(self._parse_buffer))
+        sha256s = itertools.repeat(self._sha256)
+        for books in self._process_pool().map(_parse_zip_members, paths, 
+                slices, buffer_sizes, sha256s):
+            for book in books:
+                self._store(book)
+
+    def _process_pool(self):
+        import concurrent.futures
+        if not self._pool:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._jobs)
+        return self._pool
+
+    def rebuild_all(self, jobs=None):
+        """Rebuild stale indexes of all existing CSVs before ingest. Uses the
+           same number of worker processes as parsing by default"""
+        if not self._dumb:
+            jobs = self._jobs if jobs is None else jobs
+            rebuilt = self._manager.rebuild_all(jobs)
+            _LOGGER.info("Rebuilt %d indexes", rebuilt)
+
+    def prune_missing(self):
+        "Remove books whose files no longer exist"
+        if self._dumb:
+            _LOGGER.warning("Nothing to prune in dumb mode")
+        else:
+            removed = self._manager.prune_missing()
+            _LOGGER.info("Pruned %d missing books", removed)
+
+    def report_duplicates(self, out):
+        """Write CSV with all paths of every book known under several paths
+           to out, the path which gets into CSVs first. Return number of
+           duplicate files and their total size"""
+        import index
+        if self._dumb:
+            _LOGGER.warning("Duplicates are not tracked in dumb mode")
+            return 0, 0
+        writer = csv.writer(out, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(("SHA1", "Size", "Path"))
+        files = 0
+        size = 0
+        for book in self._manager.duplicates():
+            sha1 = book.file.sha1.hex()
+            book_size = book.file.size or 0
+            for path in index.paths(book):
+                writer.writerow((sha1, str(book_size), path))
+            files += len(book.duplicates)
+            size += len(book.duplicates) * book_size
+        _LOGGER.info("%d duplicate files, %d bytes", files, size)
+        return files, size
+
+    def watch(self, dirs, kind="auto", interval=None, debounce=None):
+        """Parse files which appear or change in dirs until interrupted. 
+           CSVs are rebuilt once no changes came for debounce seconds
+           @param kind One of watch.watchers()"""
+        import daemon
+        import watch
+        if interval is None: interval = watch.DEFAULT_INTERVAL
+        if debounce is None: debounce = daemon.DEFAULT_DEBOUNCE
+        watcher = watch.open(dirs, kind, interval)
+        try:
+            with daemon.Ingester(self, debounce) as ingester:
+                while True:
+                    ingester.add(*watcher.changes(timeout=interval))
+        except KeyboardInterrupt:
+            _LOGGER.info("Interrupted")
+        finally:
+            watcher.close()
 
     def build_all_csvs(self):
         if not self._dumb:
@@ -140,22 +323,159 @@ class BookDesc:
             self._manager.build_all_csvs()
             _LOGGER.info("CSVs rebuilt")
 
+def _readahead(srcs, depth):
+    """Yield srcs, but ask the OS to start reading depth of them before they
+       are yielded"""
+    import sources
+    ahead = collections.deque()
+    for src in srcs:
+        if isinstance(src, sources.Source): src.will_need()
+        ahead.append(src)
+        if len(ahead) > depth: yield ahead.popleft()
+    yield from ahead
+
+def _prefetch(src):
+    """Read src into memory in a pool thread. Return None if it's not an FB2
+       (only its first bytes are read then) or can't be read"""
+    import fb2_parser
+    import sources
+    try:
+        prefetched = sources.prefetch(src, fb2_parser.sniff, 
+            fb2_parser._SNIFF_LEN)
+    except Exception as error:
+        _LOGGER.warning("Can't read %s: %s", src, error)
+        return None
+    if not prefetched: 
+        _LOGGER.warning("No <FictionBook near the start of %s, skipped", src)
+    return prefetched
+
+def _is_fb2(src):
+    "Can src be an FB2? Actual contents are sniffed when parsing"
+    return src.ext() in _CANDIDATE_EXTS
+
+def _parse_book(fb2_src, buffer, sha256=False, known=None):
+    """Parse src which should be an FB2 file, return Book or None. See
+       fb2_parser.parse() for known"""
+    import fb2_parser
+    _LOGGER.info("Parsing %s", fb2_src)
+    with fb2_src.open("rb") as stream:
+        book = None
+        try:
+            book = fb2_parser.parse(stream, buffer=buffer, sniff=True, 
+                sha256=sha256, known=known)
+            book.file.path = fb2_src.path()
+            book.file.mod_time = fb2_src.mtime()
+            size = fb2_src.size()
+            if size is not None: book.file.size = size
+        except fb2_parser.NotFB2Error:
+            _LOGGER.warning("No <FictionBook near the start of %s, skipped", 
+                fb2_src)
+            return None
+        except:
+            _LOGGER.exception("FB2 '%s' could not be parsed", fb2_src)
+            book = None
+        if not book:
+            _LOGGER.warning("Couldn't parse book %s", fb2_src)
+        return book
+
+def _split(seq, parts):
+    "Split seq into at most parts contiguous slices"
+    step = max(1, -(-len(seq) // parts))
+    return [seq[i:i+step] for i in range(0, len(seq), step)]
+
+# Parse buffer of the worker process, allocated on first use
+_WORKER_BUFFER = None
+
+def _parse_zip_members(zip_path, names, buffer_size, sha256):
+    "Worker process side of BookDesc._parse_zip_parallel"
+    import sources
+    global _WORKER_BUFFER
+    if _WORKER_BUFFER is None or len(_WORKER_BUFFER) != buffer_size: 
+        _WORKER_BUFFER = bytearray(buffer_size)
+    books = []
+    listing = sources.open_zip(zip_path, names)
+    if not listing:
+        _LOGGER.warning("Can't reopen %s in worker", zip_path)
+        return books
+    with listing:
+        _parse_all(listing, _WORKER_BUFFER, sha256, books)
+    return books
+
+def _parse_all(srcs, buffer, sha256, books):
+    "Parse srcs (recursing into nested Sources), append Books to books"
+    import sources
+    for src in srcs.sources():
+        if isinstance(src, sources.Sources):
+            with src:
+                _parse_all(src, buffer, sha256, books)
+        elif _is_fb2(src):
+            book = _parse_book(src, buffer, sha256)
+            if book: books.append(book)
+
 def parse_args():
+    import i18n
+    # --connect only sends paths to the daemon, which has everything else, so
+    # the client neither imports nor checks against CSV formats, backends
+    # and watchers
+    if _is_client(sys.argv[1:]):
+        backends = formats = watcher_kinds = default_backend = None
+    else:
+        import csv_manager
+        import keyvalue
+        import watch
+        backends = keyvalue.backends()
+        formats = csv_manager.formats()
+        watcher_kinds = watch.watchers()
+        default_backend = keyvalue.DEFAULT_BACKEND
     parser = argparse.ArgumentParser(description=\
         i18n.translate('BOOKDESC_SHORTDESCRIPTION'))
     parser.add_argument('-I', '--info', action = "store_true",
         help=i18n.translate('Display program infomration (long)'))
     parser.add_argument('out', metavar='OUT', type=str, nargs=1,
         help=i18n.translate('an output file or folder to put CSVs to'))
-    parser.add_argument('inputs', metavar='INPUT', type=str, nargs='+',
+    parser.add_argument('inputs', metavar='INPUT', type=str, nargs='*',
         help=i18n.translate('an input (file or folder) to parse .fb2 from'))
     parser.add_argument('-d', '--dumb', action = "store_true",
         help=i18n.translate('dumb mode'))
     parser.add_argument('-b', '--backend', type=str, 
-        choices = keyvalue.backends(), 
-        default = keyvalue.DEFAULT_BACKEND,
+        choices = backends, 
+        default = default_backend,
         help=i18n.translate('dedup backend (default:') + ' ' + \
-            keyvalue.DEFAULT_BACKEND + ")")
+            str(default_backend) + ")")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help=i18n.translate('number of worker processes for .zip archives')\
+            + ' ' + i18n.translate('(default: 1)'))
+    parser.add_argument('--async-opens', metavar='N', type=int, default=0,
+        help=i18n.translate('ASYNC_OPENS'))
+    parser.add_argument('--buffer-size', type=int, default=1,
+        help=i18n.translate('read buffer size in megabytes')\
+            + ' ' + i18n.translate('(default: 1)'))
+    parser.add_argument('--sha256', action = "store_true",
+        help=i18n.translate('also compute SHA-256 and write SHA256 column'))
+    parser.add_argument('--format', type=str, dest="csv_format",
+        choices = formats, default = "gzip",
+        help=i18n.translate('CSV file format (default: gzip)'))
+    parser.add_argument('--offsets', action = "store_true",
+        help=i18n.translate('OFFSETS'))
+    parser.add_argument('--rebuild-all', action = "store_true",
+        help=i18n.translate('REBUILD_ALL'))
+    parser.add_argument('--prune-missing', action = "store_true",
+        help=i18n.translate('PRUNE_MISSING'))
+    parser.add_argument('--duplicates', action = "store_true",
+        help=i18n.translate('DUPLICATES'))
+    parser.add_argument('--daemon', metavar='SOCKET', type=str,
+        help=i18n.translate('DAEMON'))
+    parser.add_argument('--debounce', metavar='SECONDS', type=float, 
+        default=2.0, help=i18n.translate('DEBOUNCE'))
+    parser.add_argument('--connect', metavar='SOCKET', type=str,
+        help=i18n.translate('CONNECT'))
+    parser.add_argument('--watch', action = "store_true",
+        help=i18n.translate('WATCH'))
+    parser.add_argument('--watcher', type=str, default="auto",
+        choices = watcher_kinds,
+        help=i18n.translate('how to watch folders (default: auto)'))
+    parser.add_argument('--poll-interval', metavar='SECONDS', type=float, 
+        default=5.0, help=i18n.translate('POLL_INTERVAL'))
     parser.add_argument('-W', '--Werror', action = "store_true", dest="werror",
         help=i18n.translate('COWARD_MODE'))
     parser.add_argument('-l', '--log-level', type=str, default="INFO",
@@ -163,29 +483,92 @@ def parse_args():
         help=i18n.translate('logging level'))
     parser.add_argument('-V', '--version', action = "store_true",
         help=i18n.translate('display version and exit'))
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.connect: return args
+    if not args.inputs and not args.prune_missing and not args.duplicates \
+            and not args.daemon:
+        parser.error(i18n.translate('at least one INPUT is required'))
+    if args.buffer_size < 1:
+        parser.error(i18n.translate("buffer size must be at least 1 megabyte"))
+    if args.offsets and args.csv_format == "gzip":
+        # offsets into compressed stream are useless for lookup()
+        parser.error(i18n.translate(
+            '--offsets requires --format plain or gzip-blocks'))
+    return args
+
+def _is_client(argv):
+    "Whether command line argv asks to --connect to a daemon"
+    return any(arg == "--connect" or arg.startswith("--connect=") 
+        for arg in argv)
     
 
 def main():
     if ("-V" in sys.argv or "--version" in sys.argv):
         print("v" + str(VERSION))
         return
+    import i18n
     if ("-I" in sys.argv) or ("--info" in sys.argv):
-        print(i18n.translate("BOOKDESC_INFO"))
+        print(i18n.translate("BOOKDESC_INFO", __doc__))
         return
     args = parse_args()
+    if args.connect:
+        import daemon
+        # the daemon knows where OUT is, so every path is an input
+        for reply in daemon.send(args.connect, args.out + args.inputs):
+            print(reply)
+        return
+    if args.dumb and args.daemon:
+        print(i18n.translate("--daemon can't be used in dumb mode"),
+            file = sys.stderr)
+        return
+    watch_dirs = [path for path in args.inputs if os.path.isdir(path)]
+    if args.watch and (args.daemon or not watch_dirs):
+        print(i18n.translate("WATCH_NEEDS_FOLDERS"), file = sys.stderr)
+        return
     if args.dumb and os.path.exists(args.out[0]):
         print(args.out[0], " ", 
             i18n.translate("DUMB_MODE_FILE_MUST_NOT_EXIST"), 
             file = sys.stderr)
         return
     log.config(werror=args.werror, log_level=args.log_level)
-    backend_func = lambda path: keyvalue.open(path, backend=args.backend)
+    import keyvalue
+    backend_func = functools.partial(keyvalue.open, backend=args.backend)
     if args.backend and args.dumb:
         _LOGGER.warning("--backend ignored for dumb mode")
-    with BookDesc(args.out[0], args.dumb, idx_backend=backend_func) as desc:
-        desc.parse_inputs(*args.inputs)
+    if args.offsets and args.dumb:
+        _LOGGER.warning("--offsets ignored for dumb mode")
+    rebuild_all = args.rebuild_all and not args.dumb
+    if rebuild_all and not keyvalue.persistent(args.backend):
+        # their indexes are gone once rebuilt in other processes
+        _LOGGER.warning("--rebuild-all ignored for in-memory backends")
+        rebuild_all = False
+    with BookDesc(args.out[0], args.dumb, idx_backend=backend_func,
+            jobs=args.jobs, buffer_size=args.buffer_size*1024*1024,
+            sha256=args.sha256, csv_format=args.csv_format, 
+            offsets=args.offsets) as desc:
+        if rebuild_all: desc.rebuild_all(args.jobs)
+        if args.async_opens > 0:
+            import asyncio
+            asyncio.run(desc.parse_inputs_async(*args.inputs, 
+                opens=args.async_opens))
+        else:
+            desc.parse_inputs(*args.inputs)
+        if args.prune_missing:
+            desc.prune_missing()
         desc.build_all_csvs()
+        if args.duplicates:
+            desc.report_duplicates(sys.stdout)
+        if args.watch:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            desc.watch(watch_dirs, args.watcher, args.poll_interval, 
+                args.debounce)
+        elif args.daemon:
+            import daemon
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                daemon.serve(desc, args.daemon, args.debounce)
+            except FileExistsError as error:
+                print(error, file = sys.stderr)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import bookdesc
+import csv_manager
+import fb2_parser
+import gzip
+import io
+import os
+import shutil
+import sources
+import tempfile
+import unittest
+
+class ParseInputsAsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.books = os.path.join(self.tmpdir, "books")
+        os.makedirs(os.path.join(self.books, "sub"))
+        with open("fb2-sample.fb2", "rb") as sample:
+            data = sample.read()
+        for i in range(5):
+            name = os.path.join(self.books, "sub" if i % 2 else "", 
+                "book%d.fb2" % i)
+            with open(name, "wb") as f:
+                f.write(data + str(i).encode("ascii"))
+        with gzip.open(os.path.join(self.books, "book.fb2.gz"), "wb") as f:
+            f.write(data)
+        with open(os.path.join(self.books, "notes.txt"), "wb") as f:
+            f.write(b'not a book')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def parse(self, name, parse):
+        out = os.path.join(self.tmpdir, name)
+        with bookdesc.BookDesc(out, True) as desc:
+            parse(desc)
+        with csv_manager.open_csv(out, "rt") as csv_file:
+            return sorted(csv_file.read().split("\r\n"))
+
+    def test_same_as_sync(self):
+        sync = self.parse("sync.csv.gz", 
+            lambda desc: desc.parse_inputs(self.books))
+        parsed = self.parse("async.csv.gz", 
+            lambda desc: asyncio.run(desc.parse_inputs_async(self.books, 
+                opens=2)))
+        self.assertEqual(8, len(parsed)) # header, 6 books and final newline
+        self.assertEqual(sync, parsed)
+
+    def test_broken_files_are_skipped(self):
+        with gzip.open(os.path.join(self.books, "book.fb2.gz"), "rb") as f:
+            data = f.read()
+        with open(os.path.join(self.books, "book.fb2.gz"), "rb") as f:
+            compressed = f.read()
+        with open(os.path.join(self.books, "truncated.fb2.gz"), "wb") as f:
+            f.write(compressed[:len(compressed)//2])
+        with open(os.path.join(self.books, "junk.fb2"), "wb") as f:
+            f.write(b"junk" * 10000)
+        sync = self.parse("sync.csv.gz", 
+            lambda desc: desc.parse_inputs(self.books))
+        parsed = self.parse("async.csv.gz", 
+            lambda desc: asyncio.run(desc.parse_inputs_async(self.books, 
+                opens=2)))
+        self.assertEqual(sync, parsed)
+
+class PrefetchTest(unittest.TestCase):
+    class Stream(io.BytesIO):
+        def close(self):
+            self.read_up_to = self.tell()
+            io.BytesIO.close(self)
+
+    def test_junk_is_not_read_past_head(self):
+        stream = self.Stream(b"junk" * 10000)
+        src = sources.PrefetchedSource(None, None)
+        src.open = lambda mode: stream
+        self.assertIsNone(sources.prefetch(src, fb2_parser.sniff, 100))
+        self.assertEqual(100, stream.read_up_to)
+
+class KnownBooksTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.out = os.path.join(self.tmpdir, "out")
+        os.makedirs(self.out)
+        self.books = os.path.join(self.tmpdir, "books")
+        self.mirror = os.path.join(self.tmpdir, "mirror")
+        for folder in (self.books, self.mirror):
+            os.makedirs(folder)
+            shutil.copy("fb2-sample.fb2", os.path.join(folder, "book.fb2"))
+        self.parse_description = fb2_parser._parse_description
+
+    def tearDown(self):
+        fb2_parser._parse_description = self.parse_description
+        shutil.rmtree(self.tmpdir)
+
+    def test_mirror_is_not_parsed_again(self):
+        with bookdesc.BookDesc(self.out, False) as desc:
+            desc.parse_inputs(self.books)
+            desc.build_all_csvs()
+        def fail(xml, full_desc): raise AssertionError("parsed again")
+        fb2_parser._parse_description = fail
+        with bookdesc.BookDesc(self.out, False) as desc:
+            desc.parse_inputs(self.mirror)
+            books = list(desc._manager.duplicates())
+        self.assertEqual(1, len(books))
+        self.assertEqual("Тестовый платный документ FictionBook 2.1",
+            books[0].name)
+        self.assertEqual(os.path.join(self.mirror, "book.fb2"), 
+            books[0].file.path)
+        self.assertEqual([os.path.join(self.books, "book.fb2")], 
+            books[0].duplicates)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -122,9 +122,11 @@ class Node(metaclass=abc.ABCMeta):
 
     def pop_smallest(self) -> Entry:
         """Remove and return the smallest entry."""
+        self._entries_changed()
         return self.entries.pop(0)
 
     def insert_entry(self, entry: Entry):
+        self._entries_changed()
         bisect.insort(self.entries, entry)
 
     def insert_entry_at_the_end(self, entry: Entry):
@@ -133,11 +135,16 @@ class Node(metaclass=abc.ABCMeta):
         This is an optimized version of `insert_entry` when it is known that
         the key to insert is bigger than any other entries.
         """
+        self._entries_changed()
         self.entries.append(entry)
 
     def remove_entry(self, key):
+        self._entries_changed()
         self.entries.pop(self._find_entry_index(key))
 
+    def _entries_changed(self):
+        """Called before entries are modified in place."""
+
     def get_entry(self, key) -> Entry:
         return self.entries[self._find_entry_index(key)]
 
@@ -241,13 +248,37 @@ class LeafNode(RecordNode):
 
 class ReferenceNode(Node):
 
-    __slots__ = ['_entry_class']
+    __slots__ = ['_entry_class', '_entries', '_separator_keys']
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
                  page: int=None, parent: 'Node'=None):
         self._entry_class = Reference
+        self._separator_keys = None
         super().__init__(tree_conf, data, page, parent)
 
+    @property
+    def entries(self) -> list:
+        return self._entries
+
+    @entries.setter
+    def entries(self, entries: list):
+        self._entries = entries
+        self._separator_keys = None
+
+    @property
+    def separator_keys(self) -> list:
+        """Keys of the references, in order.
+
+        Cached on the node to route searches with bisect instead of
+        comparing with every reference.
+        """
+        if self._separator_keys is None:
+            self._separator_keys = [entry.key for entry in self._entries]
+        return self._separator_keys
+
+    def _entries_changed(self):
+        self._separator_keys = None
+
     @property
     def num_children(self) -> int:
         return len(self.entries) + 1 if self.entries else 0
@@ -1,5 +1,7 @@
+import bisect
 from functools import partial
 from logging import getLogger
+import os
 from typing import Optional, Union, Iterator, Iterable
 
 from . import utils
@@ -18,7 +20,7 @@ logger = getLogger(__name__)
 class BPlusTree:
 
     __slots__ = ['_filename', '_tree_conf', '_mem', '_root_node_page',
-                 '_is_open', 'LonelyRootNode', 'RootNode', 'InternalNode',
+                 '_is_open', '_cache_size', 'LonelyRootNode', 'RootNode', 'InternalNode',
                  'LeafNode', 'OverflowNode', 'Record', 'Reference']
 
     # ######################### Public API ################################
@@ -32,6 +34,7 @@ class BPlusTree:
             serializer or IntSerializer()
         )
         self._create_partials()
+        self._cache_size = cache_size
         self._mem = FileMemory(filename, self._tree_conf,
                                cache_size=cache_size)
         try:
@@ -158,6 +161,58 @@ class BPlusTree:
             if node is not None:
                 self._mem.set_node(node)
 
+    def delete(self, key):
+        """Remove the record at key from the tree.
+
+        Raises KeyError if there is no such record. Nodes are not merged
+        after a delete: underfull leaves stay in place until `compact`.
+        """
+        with self._mem.write_transaction:
+            node = self._search_in_tree(key, self._root_node)
+            try:
+                record = node.get_entry(key)
+            except ValueError:
+                raise KeyError(key)
+
+            if record.overflow_page:
+                self._delete_overflow(record.overflow_page)
+
+            node.remove_entry(key)
+            self._mem.set_node(node)
+
+    def compact(self, drop=()):
+        """Rewrite the tree densely and replace the file with the result.
+
+        Leaves are filled completely and pages sitting in the freelist are
+        dropped, so the file shrinks. Records with keys in `drop` (a set) are
+        left out, which is much faster than deleting many of them one by
+        one. Requires free disk space for a copy of the live records. The
+        tree must not be used concurrently.
+        """
+        compact_filename = self._filename + '.compact'
+        for leftover in (compact_filename, compact_filename + '-wal'):
+            if os.path.exists(leftover):
+                os.unlink(leftover)
+
+        compacted = BPlusTree(
+            compact_filename, page_size=self._tree_conf.page_size,
+            order=self._tree_conf.order, key_size=self._tree_conf.key_size,
+            value_size=self._tree_conf.value_size,
+            cache_size=self._cache_size, serializer=self._tree_conf.serializer
+        )
+        try:
+            compacted.batch_insert((key, value) for key, value
+                                   in self.items() if key not in drop)
+        finally:
+            compacted.close()
+
+        self.close()
+        os.replace(compact_filename, self._filename)
+        self._mem = FileMemory(self._filename, self._tree_conf,
+                               cache_size=self._cache_size)
+        self._root_node_page, self._tree_conf = self._mem.get_metadata()
+        self._is_open = True
+
     def get(self, key, default=None) -> bytes:
         with self._mem.read_transaction:
             node = self._search_in_tree(key, self._root_node)
@@ -178,6 +233,9 @@ class BPlusTree:
     def __setitem__(self, key, value):
         self.insert(key, value, replace=True)
 
+    def __delitem__(self, key):
+        self.delete(key)
+
     def __getitem__(self, item):
         with self._mem.read_transaction:
 
@@ -313,28 +371,20 @@ class BPlusTree:
                 return
 
     def _search_in_tree(self, key, node) -> 'Node':
-        if isinstance(node, (LonelyRootNode, LeafNode)):
-            return node
-
-        page = None
-
-        if key < node.smallest_key:
-            page = node.smallest_entry.before
-
-        elif node.biggest_key <= key:
-            page = node.biggest_entry.after
-
-        else:
-            for ref_a, ref_b in utils.pairwise(node.entries):
-                if ref_a.key <= key < ref_b.key:
-                    page = ref_a.after
-                    break
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            # Reference i routes keys in [keys[i], keys[i+1]) to its after
+            # page, keys below keys[0] go to the before page of the first one
+            i = bisect.bisect_right(node.separator_keys, key)
+            if i == 0:
+                page = node.smallest_entry.before
+            else:
+                page = node.entries[i-1].after
 
-        assert page is not None
+            child_node = self._mem.get_node(page)
+            child_node.parent = node
+            node = child_node
 
-        child_node = self._mem.get_node(page)
-        child_node.parent = node
-        return self._search_in_tree(key, child_node)
+        return node
 
     def _split_leaf(self, old_node: 'Node'):
         """Split a leaf Node to allow the tree to grow."""
@@ -15,7 +15,13 @@ is done because parsing CSVs is faster than parsing FB2s, and, because FB2s may
 not be available already. 
 
 The manager remembers the CSV file length + modification time in the index, so 
-if that information matches, there is no need to rebuild the index.
+if that information matches, there is no need to rebuild the index. Once the
+index is modified, that information is reset until the CSV is rebuilt.
+
+Besides, the index keeps a checkpoint of the CSV: number of rows, number of
+characters and a digest of the text. If the CSV still starts with the same 
+text (rows were appended to it by some other tool), only the appended rows are
+parsed.
 
 When index is re-built, the user of the manager may add more books to it. At 
 the end, the user may ask the manager to re-build CSVs from the indexes.
@@ -23,19 +29,38 @@ the end, the user may ask the manager to re-build CSVs from the indexes.
 Therefore, indexes can be removed by the user at any time prior to bookdesk run
 or kept in place since it is more efficient to keep them.
 
-The CSV files are compressed using gzip compression by default
+The CSV files are compressed using gzip compression by default, plain CSVs
+can be written instead.
+
+Rows in CSVs are ordered by SHA1. For plain CSVs, the manager can also write
+a small sidecar table (.offsets, a CSV itself) with SHA1 and byte offset of 
+every few hundredth row, so lookup() finds a SHA1 by a binary search and a 
+single seek.
+
+The gzip-blocks format is a compromise between the two: the CSV is written as
+a sequence of independent gzip members of about 64Kb each (the header being
+the first member), which is still a valid .gz file, so zcat and zgrep work as
+usual. The .offsets table then holds SHA1 and offset of the first row of every
+member, so a lookup decompresses only one member and the indexes are rebuilt
+by decompressing members in parallel.
 """
 
+import bisect
 import book_model
+import collections
+import concurrent.futures
 import csv
 import csv_parser
 import gzip
+import hashlib
+import io
 import os
 import os.path
 import index
 import log
 import keyvalue
 import re
+import sources
 
 _LOGGER = log.get("bookdesc.csv_manager")
 
@@ -56,6 +81,110 @@ def _book2file_std(book):
                     return "0"
     return "_"
 
+# Row every _OFFSET_EVERY rows gets into .offsets table
+_OFFSET_EVERY = 256
+_OFFSETS_EXT = ".offsets"
+_OFFSETS_HEADER = ("SHA1", "Offset")
+# Approximate size of uncompressed gzip-blocks member
+_BLOCK_SIZE = 64*1024
+# Characters to read at once when skipping checkpointed text
+_COPY_CHUNK = 1024*1024
+# Number of threads decompressing gzip-blocks members
+_INFLATE_THREADS = min(4, os.cpu_count() or 1)
+
+def _open_gzip(path, mode):
+    return gzip.open(path, mode, encoding="utf-8", newline="")
+
+def _open_plain(path, mode):
+    return open(path, mode, encoding="utf-8", newline="")
+
+def _open_blocks(path, mode):
+    if mode.startswith("w"):
+        return _BlockGzipFile(path)
+    return _open_gzip(path, mode)
+
+# Format -> (opener, default CSV extension)
+_FORMATS = {
+    "gzip": (_open_gzip, ".csv.gz"),
+    "gzip-blocks": (_open_blocks, ".csv.gz"),
+    "plain": (_open_plain, ".csv")
+}
+
+def formats(): return list(_FORMATS.keys())
+
+def open_csv(path, mode, csv_format="gzip"):
+    "Open CSV file in the given format in text mode"
+    opener, _ = _FORMATS[csv_format]
+    return opener(path, mode)
+
+def lookup(csv_path, sha1, offsets_path=None):
+    """Find book with sha1 (bytes) in a plain or gzip-blocks CSV written with 
+       offsets table, without reading the whole CSV. Return Book or None"""
+    if not offsets_path: offsets_path = csv_path + _OFFSETS_EXT
+    sha1_hex = sha1.hex()
+    keys, offsets = _read_offsets(offsets_path)
+    i = bisect.bisect_right(keys, sha1_hex)
+    if i == 0: return None
+    parser = csv_parser.Parser()
+    if csv_path.endswith(".gz"):
+        with open(csv_path, "rb") as raw:
+            parser.parse_header(next(_inflate_rows(raw, 0, offsets[0])))
+            end = offsets[i] if i < len(offsets) else None
+            rows = list(_inflate_rows(raw, offsets[i-1], end))
+        return _find_row(parser, rows, sha1_hex)
+    # offsets are in bytes, so seek in binary and decode lines ourselves
+    with open(csv_path, "rb") as raw:
+        parser.parse_header(next(_decoded_rows(raw)))
+        raw.seek(offsets[i-1])
+        return _find_row(parser, _decoded_rows(raw), sha1_hex)
+
+def _decoded_rows(raw):
+    return csv.reader(line.decode("utf-8") for line in raw)
+
+def _find_row(parser, rows, sha1_hex):
+    for row in rows:
+        if row[0] == sha1_hex: return parser.parse_row(row)
+        if row[0] > sha1_hex: return None
+    return None
+
+def _read_block(raw, start, end):
+    raw.seek(start)
+    return raw.read(end - start if end is not None else -1)
+
+def _inflate(block):
+    return gzip.decompress(block).decode("utf-8")
+
+def _inflate_rows(raw, start, end):
+    return csv.reader(io.StringIO(_inflate(_read_block(raw, start, end)),
+        newline=""))
+
+def read_blocks(csv_path, offsets, threads=_INFLATE_THREADS):
+    """Yield decompressed text of every member of gzip-blocks CSV in order,
+       header first. Members are decompressed by a pool of threads (zlib
+       releases GIL), offsets are from the .offsets table"""
+    starts = [0] + offsets
+    ends = offsets + [None]
+    with open(csv_path, "rb") as raw, \
+         concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for start, end in zip(starts, ends):
+            pending.append(pool.submit(_inflate, _read_block(raw, start, end)))
+            if len(pending) > 2*threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _read_offsets(offsets_path):
+    keys = []
+    offsets = []
+    with _open_plain(offsets_path, "rt") as offsets_file:
+        reader = csv.reader(offsets_file)
+        next(reader)
+        for key, offset in reader:
+            keys.append(key)
+            offsets.append(int(offset))
+    return keys, offsets
+
 def _mtime_os(path):
     "Standard os.stat() implementation for mtime"
     try:
@@ -64,15 +193,32 @@ def _mtime_os(path):
     except FileNotFoundError:
         return None
 
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 class Manager:
-    def __init__(self, path, book2file=_book2file_std, csv_ext=".csv.gz", 
+    def __init__(self, path, book2file=_book2file_std, csv_ext=None, 
                        idx_ext=".idx", idx_backend=keyvalue.open, 
-                       isdir = os.path.isdir):
+                       isdir = os.path.isdir, sha256 = False, 
+                       csv_format = "gzip", offsets = False):
         """@param path The root path at which all files have to be kept
            @param book2file Mapping function, takes in Book, should resolve to
-                  filename (without .csv suffix) where Book has to be stored."""
+                  filename (without .csv suffix) where Book has to be stored.
+           @param csv_ext Extension of CSV files (default depends on format)
+           @param sha256 Write optional SHA256 column to CSVs
+           @param csv_format One of formats()
+           @param offsets Write .offsets table next to each CSV (only makes
+                  sense for plain format, gzip-blocks always has one)"""
         assert book2file
         assert path
+        assert csv_format in _FORMATS
+        assert not offsets or csv_format != "gzip", \
+            "offsets can't be looked up in gzip CSV"
+        csvopen, default_ext = _FORMATS[csv_format]
+        if csv_ext is None: csv_ext = default_ext
         assert csv_ext is not None
         assert idx_ext is not None
         assert csv_ext != idx_ext
@@ -81,20 +227,32 @@ class Manager:
         self._csv_ext = csv_ext
         self._idx_ext = idx_ext
         self._single_file = not isdir(path)
+        self._sha256 = sha256
+        self._csv_format = csv_format
+        self._blocks = csv_format == "gzip-blocks"
+        self._offsets = offsets or self._blocks
 
         # dependency-injectable (for testing)
-        self._csvopen = gzip.open
+        self._csvopen = csvopen
+        self._open = _open_plain
         self._idx_backend = idx_backend
         self._rename = os.rename
+        self._remove = _remove_if_exists
         self._mtime = _mtime_os
+        self._listdir = os.listdir
+        self._idx_exists = keyvalue.exists
 
         self._indexes = {}
+        self._modified = set()
+        self._blooms = None # see find()
 
     def close(self):
         "Close all indexes opened so far"
         for idx in self._indexes.values():
             idx.close()
         self._indexes = {}
+        self._modified = set()
+        self._blooms = None
 
     def __enter__(self): return self
     def __exit__(self, type, value, traceback): self.close()
@@ -102,27 +260,169 @@ class Manager:
     def put(self, book):
         "Put book to appropriate index"
         filename = self._book2file_safe(book)
-        idx = self._indexes.get(filename)
-        if not idx:
-            idx = self._rebuild(filename)
-            self._indexes[filename] = idx
+        idx = self._index(filename)
+        self._modify(filename, idx)
         idx.save(book)
 
+    def find(self, sha1):
+        """Return the book with sha1 from whichever index has it, or None.
+           Bloom filters of the indexes answer for most unknown books. For 
+           indexes which are not open, persisted filters are read on the 
+           first call and the index is only opened if it may have the book"""
+        if self._blooms is None:
+            self._blooms = {filename: self._read_bloom(filename)
+                for filename in self._all_filenames()
+                if filename not in self._indexes}
+        for idx in self._indexes.values():
+            book = idx.load(sha1)
+            if book: return book
+        for filename, bloom in self._blooms.items():
+            if filename in self._indexes: continue # looked up above
+            if bloom is None or sha1 in bloom:
+                book = self._index(filename).load(sha1)
+                if book: return book
+        return None
+
+    def prune_missing(self, exists=sources.exists):
+        """Remove books whose files no longer exist from all indexes and 
+           compact the indexes that lost books. Books which still exist under
+           one of their duplicate paths are kept under that path. CSVs are 
+           updated by the next build_all_csvs(). Books with relative paths
+           are kept, since it's unknown what they are relative to. Return 
+           number of books removed"""
+        removed = 0
+        relative = 0
+        for filename in self._all_filenames():
+            idx = self._index(filename)
+            missing = []
+            moved = []
+            for book in idx.list():
+                paths = index.paths(book)
+                if not all(os.path.isabs(path) for path in paths):
+                    relative += 1
+                    continue
+                existing = [path for path in paths if exists(path)]
+                if not existing and paths:
+                    missing.append(book.file.sha1)
+                elif existing != paths:
+                    book.file.path = existing[0]
+                    book.duplicates = existing[1:]
+                    moved.append(book)
+            if missing or moved:
+                self._modify(filename, idx)
+                for book in moved:
+                    idx.replace(book)
+                idx.compact(drop=missing)
+                removed += len(missing)
+                _LOGGER.info("Pruned %d missing books from %s", len(missing),
+                    self._csv_path(filename))
+        if relative:
+            _LOGGER.warning("Kept %d books with relative paths, can't check "
+                "whether they exist. Give absolute INPUT paths to avoid that",
+                relative)
+        return removed
+
+    def duplicates(self):
+        "Generator over books which are known under more than one path"
+        for filename in sorted(set(self._all_filenames()) | 
+                set(self._indexes)):
+            for book in self._index(filename).list():
+                if getattr(book, "duplicates", None): yield book
+
+    def rebuild_all(self, jobs=1):
+        """Eagerly rebuild indexes of all CSVs which have changed since their
+           indexes were built, in jobs worker processes. Index backend has to
+           be pickleable and must not be in-memory for jobs > 1. Return 
+           number of indexes rebuilt"""
+        stale = [fname for fname in self._all_filenames() 
+            if fname not in self._indexes and self._is_stale(fname)]
+        if jobs <= 1 or len(stale) <= 1:
+            for fname in stale:
+                self._index(fname)
+            return len(stale)
+        _LOGGER.info("Rebuilding %d indexes in %d processes", len(stale), jobs)
+        settings = dict(csv_ext=self._csv_ext, idx_ext=self._idx_ext,
+            idx_backend=self._idx_backend, sha256=self._sha256,
+            csv_format=self._csv_format)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(_rebuild_worker, self._path, fname, 
+                settings) for fname in stale]
+            for future in futures:
+                future.result()
+        return len(stale)
+
     def build_all_csvs(self):
         "Rebuild all CSV files for which we have modified the indexes"
-        for fname, idx in self._indexes.items():
+        for fname in sorted(self._modified):
+            idx = self._indexes[fname]
             old_fname = self._csv_path(fname)
             new_fname = old_fname + "_new"
             _LOGGER.debug("Building %s", new_fname)
             with self._csvopen(new_fname, "wt") as csv_stream:
-                writer = csv.writer(csv_stream, quoting=csv.QUOTE_MINIMAL)
-                writer.writerow(csv_parser.CSV_HEADER)
+                writer = _CsvWriter(csv_stream, self._offsets, self._blocks)
+                writer.writeheader(csv_parser.header(self._sha256))
                 for book in idx.list():
-                    row = csv_parser.to_row(book)
+                    row = csv_parser.to_row(book, self._sha256)
                     writer.writerow(row)
+            idx.set("checkpoint", writer.checkpoint.checkpoint())
             idx.set("mtime", self._mtime(new_fname))
+            offsets_fname = old_fname + _OFFSETS_EXT
+            if self._offsets:
+                self._write_offsets(offsets_fname + "_new", writer.offsets)
+            else:
+                self._remove(offsets_fname)
             self._rename(new_fname, old_fname)
+            if self._offsets:
+                self._rename(offsets_fname + "_new", offsets_fname)
             _LOGGER.info("Built %s", old_fname)
+        self._modified = set()
+
+    def _write_offsets(self, path, offsets):
+        with self._open(path, "wt") as offsets_stream:
+            writer = csv.writer(offsets_stream, quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(_OFFSETS_HEADER)
+            for key, offset in offsets:
+                writer.writerow((key, str(offset)))
+
+    def _index(self, filename):
+        idx = self._indexes.get(filename)
+        if not idx:
+            idx = self._rebuild(filename)
+            self._indexes[filename] = idx
+        return idx
+
+    def _modify(self, filename, idx):
+        "Mark index as no longer matching its CSV"
+        if filename not in self._modified:
+            idx.set("mtime", 0)
+            # nor its checkpoint, should we die before build_all_csvs()
+            idx.set("checkpoint", None)
+            self._modified.add(filename)
+
+    def _is_stale(self, filename):
+        """Whether index of the filename does not match its CSV. A missing
+           index is not created to find that out"""
+        if not self._idx_exists(self._idx_path(filename)): return True
+        mtime = index.read_meta(self._idx_path(filename), "mtime", 
+            idx_backend=self._idx_backend)
+        return mtime != self._mtime(self._csv_path(filename))
+
+    def _read_bloom(self, filename):
+        """Bloom filter persisted in index of the filename, or None if there
+           is none or the index is stale"""
+        if self._is_stale(filename): return None
+        return index.read_meta(self._idx_path(filename), "bloom", 
+            idx_backend=self._idx_backend)
+
+    def _all_filenames(self):
+        "Return filenames of all CSVs existing at path"
+        if self._single_file:
+            return [''] if self._mtime(self._path) else []
+        filenames = []
+        for name in self._listdir(self._path):
+            if name.endswith(self._csv_ext):
+                filenames.append(name[:-len(self._csv_ext)])
+        return filenames
 
     def _rebuild(self, filename):
         idx_path = self._idx_path(filename)
@@ -137,25 +437,77 @@ class Manager:
         if index_mtime_matches_current: 
             _LOGGER.debug("mtime matches between %s and %s", 
                 idx_path, csv_path)
-            idx.set("mtime", 0)
             return idx
 
         _LOGGER.debug("Rebuilding %s", idx_path)
+        checkpoint = idx.get("checkpoint")
+        if checkpoint:
+            checkpoint = self._parse_tail(csv_path, checkpoint, idx)
+        if not checkpoint:
+            if self._blocks:
+                checkpoint = self._parse_blocks(csv_path, idx)
+            else:
+                checkpoint = self._parse_all(csv_path, idx)
+        idx.set("checkpoint", checkpoint)
+        idx.set("mtime", current_mtime)
+        _LOGGER.info("Rebuilt %s", idx_path)
+        return idx
+
+    def _parse_tail(self, csv_path, checkpoint, idx):
+        """Parse only rows appended to CSV after the checkpoint. Return new
+           checkpoint or None if CSV does not start with the checkpointed
+           text anymore"""
+        rows, chars, digest, header = checkpoint
         parser = csv_parser.Parser()
+        parser.parse_header(header)
+        counter = _Checkpoint()
         with self._csvopen(csv_path, "rt") as csv_file:
-            reader = csv.reader(csv_file)
-            header = True
+            if not counter.skip(csv_file, chars) or counter.digest() != digest:
+                _LOGGER.debug("%s was rewritten, parsing all of it", csv_path)
+                return None
+            counter.rows = rows
+            counter.header = header
+            reader = csv.reader(counter.lines(csv_file))
+            self._parse_rows(reader, parser, idx, counter)
+        _LOGGER.debug("Parsed %d new rows of %s", counter.rows - rows, 
+            csv_path)
+        return counter.checkpoint()
+
+    def _parse_all(self, csv_path, idx):
+        parser = csv_parser.Parser()
+        counter = _Checkpoint()
+        with self._csvopen(csv_path, "rt") as csv_file:
+            reader = csv.reader(counter.lines(csv_file))
+            counter.header = next(reader, [])
+            parser.parse_header(counter.header)
+            self._parse_rows(reader, parser, idx, counter)
+        return counter.checkpoint()
+
+    def _parse_blocks(self, csv_path, idx):
+        try:
+            _, offsets = _read_offsets(csv_path + _OFFSETS_EXT)
+        except FileNotFoundError:
+            _LOGGER.warning("No block index for %s, reading sequentially",
+                csv_path)
+            return self._parse_all(csv_path, idx)
+        parser = csv_parser.Parser()
+        counter = _Checkpoint()
+        for text in read_blocks(csv_path, offsets):
+            counter.update(text)
+            reader = csv.reader(io.StringIO(text, newline=""))
+            if counter.header is None:
+                counter.header = next(reader)
+                parser.parse_header(counter.header)
             for row in reader:
-                if header:
-                    parser.parse_header(row)
-                    header = False
-                else:
-                    book = parser.parse_row(row)
-                    idx.save(book)
-        current_mtime = self._mtime(csv_path)
-        idx.set("mtime", 0)
-        _LOGGER.info("Rebuilt %s", idx_path)
-        return idx
+                idx.save(parser.parse_row(row))
+                counter.rows += 1
+        return counter.checkpoint()
+
+    def _parse_rows(self, reader, parser, idx, counter):
+        for row in reader:
+            book = parser.parse_row(row)
+            idx.save(book)
+            counter.rows += 1
 
     def _book2file_safe(self, book):
         if self._single_file:
@@ -174,3 +526,125 @@ class Manager:
             return self._path + self._idx_ext
         else:
             return os.path.join(self._path, filename + self._idx_ext)
+
+def _rebuild_worker(path, filename, settings):
+    "Rebuild index of a single CSV in a worker process"
+    with Manager(path, **settings) as manager:
+        manager._index(filename)
+
+class _CsvWriter:
+    """Writes rows into CSV text stream. If asked to, remembers SHA1 and 
+       byte offset of every _OFFSET_EVERY-th row in offsets. For gzip-blocks
+       stream (_BlockGzipFile), remembers first row of every member instead"""
+
+    def __init__(self, stream, track_offsets, blocks=False):
+        self._stream = stream
+        self._blocks = blocks
+        self._offset = 0
+        self.checkpoint = _Checkpoint(stream)
+        self.offsets = [] if track_offsets else None
+        if track_offsets and not blocks:
+            # format every row separately to know its length in bytes
+            self._line = io.StringIO()
+            self._writer = csv.writer(self._line, quoting=csv.QUOTE_MINIMAL)
+        else:
+            self._line = None
+            self._writer = csv.writer(self.checkpoint, 
+                quoting=csv.QUOTE_MINIMAL)
+
+    def writeheader(self, header):
+        self.checkpoint.header = header
+        self._write(header)
+        if self._blocks: self._stream.end_block()
+
+    def writerow(self, row):
+        if self._blocks:
+            if self._stream.pending() >= _BLOCK_SIZE: self._stream.end_block()
+            if self._stream.pending() == 0:
+                self.offsets.append((row[0], self._stream.tell()))
+        elif self.offsets is not None and \
+                self.checkpoint.rows % _OFFSET_EVERY == 0:
+            self.offsets.append((row[0], self._offset))
+        self.checkpoint.rows += 1
+        self._write(row)
+
+    def _write(self, row):
+        if self._line is None:
+            self._writer.writerow(row)
+        else:
+            self._line.seek(0)
+            self._line.truncate()
+            self._writer.writerow(row)
+            line = self._line.getvalue()
+            self.checkpoint.write(line)
+            self._offset += len(line.encode("utf-8"))
+
+class _Checkpoint:
+    """Counts rows and characters of CSV text written or read so far, and 
+       digests the text, so the index can later tell whether CSV still starts
+       with the same text. Passes written text on to stream"""
+
+    def __init__(self, stream=None):
+        self._stream = stream
+        self._digest = hashlib.sha1()
+        self.header = None
+        self.rows = 0
+        self.chars = 0
+
+    def update(self, text):
+        self.chars += len(text)
+        self._digest.update(text.encode("utf-8"))
+
+    def write(self, text):
+        self.update(text)
+        return self._stream.write(text)
+
+    def lines(self, stream):
+        for line in stream:
+            self.update(line)
+            yield line
+
+    def skip(self, stream, chars):
+        "Read and digest chars from stream, return False if it is shorter"
+        while self.chars < chars:
+            text = stream.read(min(_COPY_CHUNK, chars - self.chars))
+            if not text: return False
+            self.update(text)
+        return True
+
+    def digest(self): return self._digest.digest()
+
+    def checkpoint(self):
+        "Pickleable (rows, chars, digest, header) tuple"
+        return (self.rows, self.chars, self.digest(), self.header)
+
+class _BlockGzipFile:
+    """Write-only text file which compresses its contents as independent gzip
+       members, one per end_block()"""
+
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._pending = io.BytesIO()
+
+    def write(self, text):
+        return self._pending.write(text.encode("utf-8"))
+
+    def pending(self):
+        "Number of uncompressed bytes waiting for the end of the member"
+        return self._pending.tell()
+
+    def tell(self):
+        "Offset at which the next member starts"
+        return self._file.tell()
+
+    def end_block(self):
+        if self.pending():
+            self._file.write(gzip.compress(self._pending.getvalue(), mtime=0))
+            self._pending = io.BytesIO()
+
+    def close(self):
+        self.end_block()
+        self._file.close()
+
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
@@ -6,9 +6,15 @@ import keyvalue
 import io
 import csv_parser
 import index
+import os
 import pickle
+import csv
 import csv_manager
+import functools
+import shutil
+import tempfile
 import unittest
+from test_helpers import KeptDb
 
 class Book2FileStdTest(unittest.TestCase):
     def setUp(self):
@@ -45,6 +51,7 @@ class ManagerTest(unittest.TestCase):
         manager._csvopen = self.csvopen
         manager._rename = self.rename
         manager._mtime = self.mtime
+        manager._idx_exists = lambda path: path in self.dbs
         return manager
         
     def setUp(self):
@@ -85,7 +92,7 @@ class ManagerTest(unittest.TestCase):
     def idxopen(self, path):
         result = self.dbs.get(path)
         if not result:
-            result = keyvalue.open(path, backend="memory")
+            result = KeptDb(path)
             self.dbs[path] = result
         return result
 
@@ -151,6 +158,141 @@ class ManagerTest(unittest.TestCase):
             lines[2])
         self.assertEqual(','.join(csv_parser.CSV_HEADER), lines[3])
 
+    def test_prune_missing(self):
+        self.book1.file.path = "/gone.fb2"
+        self.book2.file.path = "/here.fb2"
+        self.manager.put(self.book1)
+        self.manager.put(self.book2)
+        self.manager.build_all_csvs()
+
+        self.manager._listdir = lambda path: [p[1:] for p in self.virtualfiles]
+        removed = self.manager.prune_missing(
+            exists=lambda path: path == "/here.fb2")
+        self.assertEqual(1, removed)
+        self.manager.build_all_csvs()
+        lines = self.virtualfiles["/a.csv.gz"].contents.split("\r\n")
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[1].startswith('30323032,30323033,book2'))
+
+    def test_prune_keeps_relative_paths(self):
+        self.book1.file.path = "books/gone.fb2"
+        self.manager.put(self.book1)
+        self.manager.build_all_csvs()
+
+        self.manager._listdir = lambda path: [p[1:] for p in self.virtualfiles]
+        removed = self.manager.prune_missing(exists=lambda path: False)
+        self.assertEqual(0, removed)
+        self.assertEqual(1, len(list(self.manager._index("a").list())))
+
+    def test_prune_keeps_existing_duplicate(self):
+        self.book1.file.path = "/gone.fb2"
+        self.manager.put(self.book1)
+        self.book1.file.path = "/copy.fb2"
+        self.manager.put(self.book1)
+        self.assertEqual([["/copy.fb2", "/gone.fb2"]], 
+            [index.paths(book) for book in self.manager.duplicates()])
+        self.manager.build_all_csvs()
+
+        self.manager._listdir = lambda path: [p[1:] for p in self.virtualfiles]
+        removed = self.manager.prune_missing(
+            exists=lambda path: path == "/copy.fb2")
+        self.assertEqual(0, removed)
+        self.assertEqual([], list(self.manager.duplicates()))
+        book = next(self.manager._index("a").list())
+        self.assertEqual("/copy.fb2", book.file.path)
+
+    def test_will_only_build_modified_csvs(self):
+        self.write_book_to_vfile("/a.csv.gz", self.book1)
+        self.manager.put(self.book2)
+        self.manager.build_all_csvs()
+        self.virtualfiles.clear()
+        self.manager.build_all_csvs()
+        self.assertEqual({}, self.virtualfiles)
+
+    def test_find_in_any_index(self):
+        self.manager.put(self.book1)
+        self.manager.put(self.book2)
+        self.manager.build_all_csvs()
+        self.manager.close()
+        self.manager = self.build_manager("/")
+        self.manager._listdir = lambda path: [p[1:] for p in self.virtualfiles]
+        self.assertEqual("book2", self.manager.find(b'0202').name)
+        self.assertEqual("book1", self.manager.find(b'0101').name)
+        self.assertEqual(None, self.manager.find(b'0303'))
+
+    def test_find_opens_only_indexes_which_may_have_book(self):
+        self.manager.put(self.book1)
+        self.manager.put(self.book2)
+        self.manager.build_all_csvs()
+        self.manager.close()
+        self.manager = self.build_manager("/")
+        self.manager._listdir = lambda path: [p[1:] for p in self.virtualfiles]
+        self.assertEqual(None, self.manager.find(b'0303'))
+        self.assertEqual({}, self.manager._indexes)
+        self.assertEqual("book2", self.manager.find(b'0202').name)
+        self.assertEqual(1, len(self.manager._indexes))
+
+    def test_offsets_are_written_for_every_nth_row(self):
+        self.manager = csv_manager.Manager(path="/", 
+            idx_backend=self.idxopen, isdir=lambda path: True,
+            csv_format="plain", offsets=True)
+        self.manager._csvopen = self.csvopen
+        self.manager._open = self.csvopen
+        self.manager._rename = self.rename
+        self.manager._mtime = self.mtime
+        for i in range(csv_manager._OFFSET_EVERY+1):
+            self.book1.file.sha1 = i.to_bytes(2, "big")
+            self.manager.put(self.book1)
+        self.manager.build_all_csvs()
+        contents = self.virtualfiles["/a.csv"].contents
+        offsets = self.virtualfiles["/a.csv.offsets"].contents.split("\r\n")
+        self.assertEqual("SHA1,Offset", offsets[0])
+        self.assertEqual(4, len(offsets))
+        for line in offsets[1:3]:
+            sha1, offset = line.split(",")
+            self.assertTrue(contents[int(offset):].startswith(sha1 + ","))
+
+    def test_appended_rows_are_parsed_incrementally(self):
+        self.manager.put(self.book1)
+        self.manager.build_all_csvs()
+        self.manager.close()
+        # book1 is only in the CSV prefix now, so it will come back only if
+        # the whole CSV is parsed again
+        idx = index.Index("/a.idx", idx_backend=self.idxopen)
+        idx.delete(self.book1.file.sha1)
+        vcsv = self.virtualfiles["/a.csv.gz"]
+        vcsv.contents += ','.join(csv_parser.to_row(self.book2)) + '\r\n'
+        self.mtime = lambda path: (1, 1)
+        self.manager = self.build_manager("/")
+        books = list(self.manager._index("a").list())
+        self.assertEqual(["book2"], [book.name for book in books])
+        rows, chars, _, _ = idx.get("checkpoint")
+        self.assertEqual(2, rows)
+        self.assertEqual(len(vcsv.contents), chars)
+
+    def test_checkpoint_is_cleared_on_first_change(self):
+        self.manager.put(self.book1)
+        self.manager.build_all_csvs()
+        self.manager.close()
+        self.manager = self.build_manager("/")
+        self.assertTrue(self.manager._index("a").get("checkpoint"))
+        self.book1.file.sha1 = b'0909'
+        self.manager.put(self.book1)
+        self.assertIsNone(self.manager._index("a").get("checkpoint"))
+
+    def test_rewritten_csv_is_parsed_again(self):
+        self.manager.put(self.book1)
+        self.manager.build_all_csvs()
+        self.manager.close()
+        idx = index.Index("/a.idx", idx_backend=self.idxopen)
+        idx.delete(self.book1.file.sha1)
+        vcsv = self.virtualfiles["/a.csv.gz"]
+        vcsv.contents = vcsv.contents.replace("book1", "BOOK1")
+        self.mtime = lambda path: (1, 1)
+        self.manager = self.build_manager("/")
+        books = list(self.manager._index("a").list())
+        self.assertEqual(["BOOK1"], [book.name for book in books])
+
     def write_book_to_vfile(self, path, book):
         with self.csvopen(path, "wb") as csv_file:
             csv_file.write(','.join(csv_parser.CSV_HEADER))
@@ -159,6 +301,148 @@ class ManagerTest(unittest.TestCase):
             csv_file.write('\r\n')
         
 
+class LookupTest(unittest.TestCase):
+    csv_format = "plain"
+    csv_name = "books.csv"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager = self.build_manager()
+        self.sha1s = []
+        for i in range(2000):
+            book = book_model.Book()
+            book.name = "Книга " + str(i)
+            book.metatext = self.metatext(i)
+            book.file = book_model.File()
+            book.file.sha1 = (i*7).to_bytes(4, "big")
+            self.sha1s.append(book.file.sha1)
+            self.manager.put(book)
+        self.manager.build_all_csvs()
+        self.csv_path = os.path.join(self.tmpdir, self.csv_name)
+
+    def metatext(self, i):
+        "Every third book has multiline metatext"
+        return "" if i % 3 else "Первая строка\r\nвторая, \"строка\" " + \
+            str(i)
+
+    def build_manager(self, offsets=True):
+        return csv_manager.Manager(path=self.tmpdir + "/",
+            idx_backend=lambda path: keyvalue.open(path, backend="memory"),
+            book2file=lambda book: "books", csv_format=self.csv_format, 
+            offsets=offsets)
+
+    def rebuild_without_offsets(self):
+        "Add a book to the CSV with a manager without offsets"
+        manager = self.build_manager(offsets=False)
+        book = book_model.Book()
+        book.name = "Одна"
+        book.file = book_model.File()
+        book.file.sha1 = b'\1'
+        manager.put(book)
+        manager.build_all_csvs()
+        manager.close()
+
+    def tearDown(self):
+        self.manager.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup_finds_every_book(self):
+        for i, sha1 in enumerate(self.sha1s):
+            book = csv_manager.lookup(self.csv_path, sha1)
+            self.assertEqual("Книга " + str(i), book.name)
+            self.assertEqual(self.metatext(i), book.metatext)
+
+    def test_lookup_of_missing_book(self):
+        self.assertIsNone(csv_manager.lookup(self.csv_path, b'\0\0\0\1'))
+        self.assertIsNone(csv_manager.lookup(self.csv_path, b'\0\0\0\0\0'))
+        self.assertIsNone(csv_manager.lookup(self.csv_path, b'\xff'))
+
+    def test_offsets_are_removed_when_disabled(self):
+        self.rebuild_without_offsets()
+        self.assertFalse(os.path.exists(self.csv_path + ".offsets"))
+
+
+class BlockLookupTest(LookupTest):
+    csv_format = "gzip-blocks"
+    csv_name = "books.csv.gz"
+
+    def test_is_valid_gzip(self):
+        with csv_manager.open_csv(self.csv_path, "rt") as csv_file:
+            rows = list(csv.reader(csv_file))
+        self.assertEqual(list(csv_parser.CSV_HEADER), rows[0])
+        self.assertEqual(len(self.sha1s)+1, len(rows))
+
+    def test_has_several_blocks(self):
+        keys, offsets = csv_manager._read_offsets(self.csv_path + ".offsets")
+        self.assertTrue(len(offsets) > 1)
+        self.assertEqual(self.sha1s[0].hex(), keys[0])
+
+    def test_rebuild_from_blocks(self):
+        self.manager.close()
+        self.manager = self.build_manager()
+        idx = self.manager._rebuild("books")
+        self.assertEqual(len(self.sha1s), len(list(idx.list())))
+        self.assertEqual("Книга 3", next(idx.find(self.sha1s[3])).name)
+
+    def test_offsets_are_removed_when_disabled(self):
+        "gzip-blocks CSV can't be read without them, so they are kept"
+        self.rebuild_without_offsets()
+        self.assertTrue(os.path.exists(self.csv_path + ".offsets"))
+        self.assertEqual("Одна", csv_manager.lookup(self.csv_path, b'\1').name)
+        self.assertEqual("Книга 0", 
+            csv_manager.lookup(self.csv_path, self.sha1s[0]).name)
+
+
+class RebuildAllTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        manager = self.build_manager()
+        for i in range(100):
+            book = book_model.Book()
+            book.authors = ["Author " + "abc"[i % 3]]
+            book.file = book_model.File()
+            book.file.sha1 = i.to_bytes(2, "big")
+            manager.put(book)
+        manager.build_all_csvs()
+        manager.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build_manager(self):
+        return csv_manager.Manager(path=self.tmpdir + "/",
+            idx_backend=functools.partial(keyvalue.open, backend="dumb"))
+
+    def remove_indexes(self):
+        for name in os.listdir(self.tmpdir):
+            if ".idx" in name: os.remove(os.path.join(self.tmpdir, name))
+
+    def test_nothing_to_rebuild(self):
+        with self.build_manager() as manager:
+            self.assertEqual(0, manager.rebuild_all(jobs=2))
+
+    def test_rebuild_in_workers(self):
+        self.remove_indexes()
+        with self.build_manager() as manager:
+            self.assertEqual(3, manager.rebuild_all(jobs=2))
+            self.assertEqual(0, manager.rebuild_all(jobs=2))
+            books = list(manager._index("b").list())
+            self.assertEqual(33, len(books))
+
+    def test_staleness_check_creates_no_index(self):
+        self.remove_indexes()
+        with self.build_manager() as manager:
+            self.assertTrue(manager._is_stale("a"))
+        self.assertEqual([], [name for name in os.listdir(self.tmpdir) 
+            if ".idx" in name])
+
+    def test_rebuild_inline(self):
+        self.remove_indexes()
+        with self.build_manager() as manager:
+            self.assertEqual(3, manager.rebuild_all())
+            self.assertEqual(34, len(list(manager._indexes["a"].list())))
+
+
 class VirtualFile:
     def __init__(self, path):
         self.path = path
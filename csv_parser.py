@@ -8,12 +8,20 @@ unquoting CSVs should be solved at one layer above - perhaps using standard
 CSV_HEADER = ("SHA1", "MD5", "Name", "Authors", "Year", "ISBN", "Path", 
              "Size", "ModTime", "MetaText")
 
+# Optional SHA256 column goes last, so CSVs without it look just the same
+CSV_HEADER_SHA256 = CSV_HEADER + ("SHA256",)
+
+def header(sha256=False):
+    "Return CSV header, with or without the optional SHA256 column"
+    return CSV_HEADER_SHA256 if sha256 else CSV_HEADER
+
 import datetime
 import book_model
 import binascii
 
-def to_row(book):
-    "Return a list of column values representing a book"
+def to_row(book, sha256=False):
+    """Return a list of column values representing a book. Columns are in 
+    the header(sha256) order"""
     f = book.file if book.file else book_model.File()
     iso8601 = _iso_8601(f.mod_time)
     authors = book.authors if book.authors else []
@@ -26,8 +34,13 @@ def to_row(book):
     year = str(book.year) if book.year else ""
     size = str(f.size) if f.size else ""
     meta = book.metatext if book.metatext else ""
-    return (sha1.hex(), md5.hex(), name, authors, year, isbn, path, size, 
+    row = (sha1.hex(), md5.hex(), name, authors, year, isbn, path, size, 
         iso8601, meta)
+    if sha256:
+        # books pickled by older versions have no sha256 at all
+        digest = getattr(f, "sha256", None)
+        row += (digest.hex() if digest else "",)
+    return row
 
 def _iso_8601(timestamp):
     if timestamp:
@@ -57,6 +70,7 @@ class Parser:
             elif v == "size": func = _parse_size
             elif v == "modtime": func = _parse_modtime
             elif v == "metatext": func = _parse_metatext
+            elif v == "sha256": func = _parse_sha256
             self._cols.append(func)
 
     def parse_row(self, values):
@@ -65,7 +79,7 @@ class Parser:
         book.file = book_model.File()
         i = 0
         for func in self._cols:
-            if i<= len(values):
+            if func and i < len(values):
                 value = values[i].strip()
                 func(book, value)
             i+=1
@@ -81,6 +95,8 @@ def _parse_modtime(book, v):
 
 def _parse_sha1(book, v): book.file.sha1 = binascii.a2b_hex(v)
 def _parse_md5(book, v): book.file.md5 = binascii.a2b_hex(v)
+def _parse_sha256(book, v): 
+    book.file.sha256 = binascii.a2b_hex(v) if v else None
 def _parse_name(book, v): book.name = v
 def _parse_year(book, v): book.year = _safe_int(v)
 def _parse_isbn(book, v): book.isbn = v
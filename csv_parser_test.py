@@ -43,6 +43,22 @@ class ParserTest(unittest.TestCase):
         csv = self.to_csv_line(book)
         self.parser.parse_row(csv.split(","))
 
+    def test_sha256_column(self):
+        self.book1.file.sha256 = b'0708'
+        row = csv_parser.to_row(self.book1, sha256=True)
+        self.assertEqual(len(csv_parser.CSV_HEADER_SHA256), len(row))
+        self.assertEqual("30373038", row[-1])
+        self.parser.parse_header(csv_parser.header(sha256=True))
+        book = self.parser.parse_row(row)
+        self.assertEqual(b'0708', book.file.sha256)
+        self.assertEqual(self.book1.file.sha1, book.file.sha1)
+
+    def test_unknown_columns_are_ignored(self):
+        self.parser.parse_header(("SHA1", "Whatever", "Name"))
+        book = self.parser.parse_row(["3031", "x", "A name"])
+        self.assertEqual(b'01', book.file.sha1)
+        self.assertEqual("A name", book.name)
+
     def to_csv_line(self, book):
         return ",".join(csv_parser.to_row(book))
 
@@ -0,0 +1,182 @@
+# -*- coding: UTF-8 -*-
+"""Daemon mode: keeps BookDesc (and thus all opened indexes) resident and
+accepts paths to parse over a Unix domain socket.
+
+Protocol is line based: client sends paths, one per line, and closes its
+side of the connection (or sends an empty line). The daemon replies with
+"QUEUED <number of paths>". A line "FLUSH" makes the daemon reply "FLUSHED"
+only after everything queued so far is parsed and CSVs are rebuilt.
+
+Paths are parsed one after another by a single thread, CSVs are rebuilt
+once no new paths have arrived for the debounce period, so a burst of adds
+results in one rebuild of the touched shards."""
+
+import errno
+import log
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+
+_LOGGER = log.get("bookdesc.daemon")
+
+DEFAULT_DEBOUNCE = 2.0 # seconds
+
+_FLUSH = "FLUSH"
+
+class Ingester:
+    "Feeds paths to BookDesc from a single worker thread"
+
+    def __init__(self, desc, debounce=DEFAULT_DEBOUNCE):
+        """@param desc BookDesc (or anything with parse_inputs and
+                  build_all_csvs)
+           @param debounce Seconds without new paths before CSVs are rebuilt"""
+        self._desc = desc
+        self._debounce = debounce
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run,
+            name="bookdesc-ingester", daemon=True)
+        self._thread.start()
+
+    def add(self, *paths):
+        "Queue paths to be parsed"
+        for path in paths:
+            self._queue.put(path)
+
+    def flush(self):
+        "Wait until all paths queued so far are parsed and CSVs are rebuilt"
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        "Parse what is queued, rebuild CSVs and stop the worker thread"
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def _run(self):
+        dirty = False
+        while True:
+            try:
+                timeout = self._debounce if dirty else None
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._build()
+                dirty = False
+                continue
+            if item is None:
+                if dirty: self._build()
+                return
+            if isinstance(item, threading.Event):
+                if dirty: self._build()
+                dirty = False
+                item.set()
+                continue
+            try:
+                self._desc.parse_inputs(item)
+                dirty = True
+            except:
+                _LOGGER.exception("Can't parse %s", item)
+
+    def _build(self):
+        try:
+            self._desc.build_all_csvs()
+        except:
+            _LOGGER.exception("Can't rebuild CSVs")
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        ingester = self.server.ingester
+        queued = 0
+        for line in self.rfile:
+            path = line.decode("utf-8").rstrip("\r\n")
+            if not path: break
+            if path == _FLUSH:
+                ingester.flush()
+                self.wfile.write(b"FLUSHED\n")
+            else:
+                ingester.add(path)
+                queued += 1
+        self.wfile.write(("QUEUED %d\n" % queued).encode("utf-8"))
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    "Accepts paths on a Unix socket and feeds them to the Ingester"
+    daemon_threads = True
+
+    def __init__(self, socket_path, ingester):
+        """Raises FileExistsError if something other than a stale socket is
+           at socket_path. The socket is only accessible by the owner"""
+        _remove_stale_socket(socket_path)
+        self.ingester = ingester
+        self._socket_path = socket_path
+        self._inode = None # of our socket, see server_close()
+        socketserver.UnixStreamServer.__init__(self, socket_path, _Handler,
+            bind_and_activate=False)
+        try:
+            self.server_bind()
+            self._inode = os.lstat(socket_path).st_ino
+            # nobody can connect until listen(), chmod before that
+            os.chmod(socket_path, 0o600)
+            self.server_activate()
+        except:
+            self.server_close()
+            raise
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        # another daemon may have replaced our socket after we stopped 
+        # listening, leave its one alone
+        try:
+            if os.lstat(self._socket_path).st_ino == self._inode:
+                os.unlink(self._socket_path)
+        except FileNotFoundError:
+            pass
+
+def _remove_stale_socket(path):
+    """Remove socket left by previous daemon. Refuse to remove anything 
+       else, including a socket some daemon still listens on"""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, "Not a socket", path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise FileExistsError(errno.EEXIST, "Daemon is already listening", path)
+
+def serve(desc, socket_path, debounce=DEFAULT_DEBOUNCE):
+    "Serve requests until interrupted, then rebuild CSVs"
+    with Ingester(desc, debounce) as ingester:
+        server = Server(socket_path, ingester)
+        _LOGGER.info("Listening on %s", socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            _LOGGER.info("Interrupted")
+        finally:
+            server.server_close()
+
+def send(socket_path, paths, flush=False):
+    "Client side: send paths to the daemon, return its replies"
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        lines = [os.path.abspath(path) for path in paths]
+        if flush: lines.append(_FLUSH)
+        sock.sendall(("\n".join(lines) + "\n").encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+        replies = []
+        with sock.makefile("rb") as reader:
+            for line in reader:
+                replies.append(line.decode("utf-8").rstrip("\n"))
+        return replies
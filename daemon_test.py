@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import daemon
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+class FakeDesc:
+    def __init__(self):
+        self.parsed = []
+        self.builds = 0
+
+    def parse_inputs(self, *inputs):
+        self.parsed.extend(inputs)
+
+    def build_all_csvs(self):
+        self.builds += 1
+
+class IngesterTest(unittest.TestCase):
+    def setUp(self):
+        self.desc = FakeDesc()
+        self.fixture = daemon.Ingester(self.desc, debounce=60)
+
+    def tearDown(self):
+        self.fixture.close()
+
+    def test_burst_is_built_once(self):
+        self.fixture.add("/a.fb2", "/b.fb2")
+        self.fixture.add("/c.fb2")
+        self.fixture.flush()
+        self.assertEqual(["/a.fb2", "/b.fb2", "/c.fb2"], self.desc.parsed)
+        self.assertEqual(1, self.desc.builds)
+        self.fixture.flush()
+        self.assertEqual(1, self.desc.builds)
+
+    def test_close_builds_what_is_left(self):
+        self.fixture.add("/a.fb2")
+        self.fixture.close()
+        self.assertEqual(1, self.desc.builds)
+        self.fixture = daemon.Ingester(self.desc)
+
+    def test_debounce(self):
+        self.fixture.close()
+        self.fixture = daemon.Ingester(self.desc, debounce=0.01)
+        built = threading.Event()
+        self.desc.build_all_csvs = built.set
+        self.fixture.add("/a.fb2")
+        self.assertTrue(built.wait(5))
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, "bookdesc.sock")
+        self.desc = FakeDesc()
+        self.ingester = daemon.Ingester(self.desc, debounce=60)
+        self.server = daemon.Server(self.socket_path, self.ingester)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.ingester.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_send(self):
+        replies = daemon.send(self.socket_path, ["/a.fb2", "b.fb2"], 
+            flush=True)
+        self.assertEqual(["FLUSHED", "QUEUED 2"], replies)
+        self.assertEqual(["/a.fb2", os.path.abspath("b.fb2")], 
+            self.desc.parsed)
+        self.assertEqual(1, self.desc.builds)
+
+    def test_socket_is_private(self):
+        mode = stat.S_IMODE(os.stat(self.socket_path).st_mode)
+        self.assertEqual(0o600, mode)
+
+    def test_replaces_stale_socket_only(self):
+        stale = os.path.join(self.tmpdir, "stale.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(stale)
+        daemon.Server(stale, self.ingester).server_close()
+        other = os.path.join(self.tmpdir, "file")
+        with open(other, "w") as f:
+            f.write("precious")
+        with self.assertRaises(FileExistsError):
+            daemon.Server(other, self.ingester)
+        with open(other) as f:
+            self.assertEqual("precious", f.read())
+
+    def test_does_not_take_over_live_socket(self):
+        with self.assertRaises(FileExistsError):
+            daemon.Server(self.socket_path, self.ingester)
+        self.assertEqual(["QUEUED 1"], 
+            daemon.send(self.socket_path, ["/a.fb2"]))
+
+    def test_close_leaves_replaced_socket(self):
+        other = os.path.join(self.tmpdir, "other.sock")
+        server = daemon.Server(other, self.ingester)
+        # keep our socket's inode alive so the new one can't reuse it
+        os.rename(other, other + ".old")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(other)
+            server.server_close()
+            self.assertTrue(os.path.exists(other))
+
+if __name__ == '__main__':
+    unittest.main()
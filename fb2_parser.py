@@ -2,8 +2,10 @@
 """Parses .fb2 files into Book models"""
 
 import book_model
+import concurrent.futures
 import hashlib
 import codecs
+import os
 import re
 import log
 import xml.etree.ElementTree as ET
@@ -14,85 +16,197 @@ _LOGGER = log.get("bookdesc.fb2_parser")
 _MEGABYTE = 1024*1024
 _MAX_ANNOTATION_LEN=1024
 _MAX_METATEXT_LEN=4096
+# Stop reading the stream into memory if </description> is not found by then
+_MAX_DESCRIPTION_LEN=8*_MEGABYTE
 
-def parse(binary_stream, buffer=None):
+# Chunks at least this large are hashed by several digests in parallel 
+# threads (hashlib releases the GIL while hashing large buffers). Pointless
+# on a single CPU
+_PARALLEL_HASH_MIN=64*1024
+_PARALLEL_HASHING=(os.cpu_count() or 1) > 1
+
+# How many bytes to look at when sniffing whether the stream is an FB2
+_SNIFF_LEN=4096
+
+class NotFB2Error(ValueError):
+    "Raised when sniffing shows that the stream is not an FB2"
+
+def parse(binary_stream, buffer=None, sniff=False, sha256=False, known=None):
     """Parse contents from fb2 binary stream. Returns None if stream does not 
-    contain any books (for ex, is empty)"""
+    contain any books (for ex, is empty). 
+    If sniff is True, first few KB of the stream are checked for FB2 root
+    element and NotFB2Error is raised if it isn't there, before the rest of
+    the stream is read.
+    If sha256 is True, SHA-256 is computed in addition to SHA1 and MD5.
+    known, if given, is called with SHA1 of the stream once it is read. If it
+    returns a Book, the description is not parsed and that Book is returned
+    with digests and size of the stream"""
     book = None
     if not buffer: buffer = bytearray(_MEGABYTE)
     if len(buffer) < _MEGABYTE: 
         raise ValueError("parse_fb2 requires at least 1Mb buffer, you gave "+\
             str(len(buffer))+" bytes")
-    checksummer = _ChecksumStream(binary_stream, buffer, "sha1", "md5")
-    size = checksummer.read()
+    digests = ("sha1", "md5", "sha256") if sha256 else ("sha1", "md5")
+    checksummer = _ChecksumStream(binary_stream, buffer, *digests)
+    size = checksummer.read(stop=_SNIFF_LEN)
     if not size: return None
+    if sniff and not _looks_like_fb2(buffer, size):
+        raise NotFB2Error("No <FictionBook in first " + str(size) + " bytes")
+    size += checksummer.read(start=size)
     encoding = _determine_encoding(buffer, size)
-    description_bytes, full_desc = _find_description(buffer, size, encoding)
-    if description_bytes:
-        xml = codecs.decode(description_bytes, encoding, errors="ignore")
-        book = _parse_description(xml, full_desc)
+    pieces, full_desc = _scan_description(checksummer, buffer, size, encoding)
+    if not pieces:
+        _LOGGER.info("Haven't found <description")
+    elif known:
+        # parsing waits for SHA1, but the buffer is reused while hashing
+        pieces = [b"".join(pieces)]
     else:
-        _LOGGER.info("""Haven't found <description in the first chunk. Will 
-continue looking for the <description tag, but unlikely will find it""")
-    while size:
-        if not book:
-            description_bytes, full_desc = _find_description(buffer, size, 
-                encoding)
-            if description_bytes:
-                _LOGGER.info("Finally, found <description")
-                xml = codecs.decode(description_bytes, encoding, errors="ignore")
-                book = _parse_description(xml, full_desc)
-        size = checksummer.read()
+        book = _parse_description(_decode(pieces, encoding), full_desc)
+    while checksummer.read(): pass
+    if known:
+        book = known(checksummer.digest("sha1"))
+        if book:
+            _LOGGER.info("Already known, not parsing the description")
+        elif pieces:
+            book = _parse_description(_decode(pieces, encoding), full_desc)
     if book:
         book.file = book_model.File()
         book.file.sha1 = checksummer.digest("sha1")
         book.file.md5 = checksummer.digest("md5")
+        if sha256: book.file.sha256 = checksummer.digest("sha256")
+        book.file.size = checksummer.total()
     return book
 
-def _find_description(buffer, size, encoding):
-    start_tag = "<description".encode(encoding)
+def _scan_description(checksummer, buffer, size, encoding):
+    """Find <description ...</description> reading the stream as needed, 
+    buffer[:size] is what was read so far.
+
+    While looking for <description, the last few bytes of the buffer are 
+    carried over to its beginning before the next read, so a tag straddling 
+    two reads is not missed. Once <description is found, the rest of it is 
+    read into new chunks (nothing read before is moved or copied) until
+    </description> is found or _MAX_DESCRIPTION_LEN is reached.
+
+    Returns (list of memoryviews, full_desc). The list is empty if there is 
+    no <description. If there is no </description>, only the part of the
+    description which was in the buffer is returned and full_desc is False"""
+    start_tag, end_tag = _encoded_tags(encoding)
     start = buffer.find(start_tag, 0, size)
-    if start < 0: return None
-    end_tag = "</description>".encode(encoding)
+    while start < 0:
+        overlap = min(len(start_tag) - 1, size)
+        buffer[:overlap] = buffer[size-overlap:size]
+        read = checksummer.read(start=overlap)
+        if not read: return [], False
+        size = overlap + read
+        start = buffer.find(start_tag, 0, size)
+
+    first = memoryview(buffer)[start:size]
     end = buffer.find(end_tag, start+1, size)
-    if end <0:
-        _LOGGER.info("Could not find </description> tag, assuming entire " + 
-                        "buffer is the description")
-        return memoryview(buffer)[start:size], False
-    else:
-        end += len(end_tag)
-    return memoryview(buffer)[start:end], True
-
-_EXTRACT_ENCODING1=re.compile('encoding="(.*?)"')
-_EXTRACT_ENCODING2=re.compile("encoding='(.*?)'")
+    if end >= 0: return [first[:end+len(end_tag)-start]], True
+
+    pieces = [first]
+    seam_len = len(end_tag) - 1
+    tail = bytes(first[-seam_len:])
+    length = len(first)
+    while length < _MAX_DESCRIPTION_LEN:
+        chunk = memoryview(bytearray(_MEGABYTE))
+        read = checksummer.read_into(chunk)
+        if not read: break
+        chunk = chunk[:read]
+        seam = tail + bytes(chunk[:seam_len])
+        end = seam.find(end_tag)
+        if end >= 0:
+            end += len(end_tag) - len(tail)
+        else:
+            end = chunk.obj.find(end_tag, 0, read)
+            if end >= 0: end += len(end_tag)
+        if end >= 0:
+            pieces.append(chunk[:end])
+            return pieces, True
+        pieces.append(chunk)
+        length += read
+        tail = (tail + bytes(chunk[-seam_len:]))[-seam_len:]
+    _LOGGER.info("Could not find </description> tag, assuming the rest of "+
+        "the buffer is the description")
+    return [first], False
+
+def _decode(pieces, encoding):
+    if len(pieces) == 1:
+        return codecs.decode(pieces[0], encoding, errors="ignore")
+    decoder = codecs.getincrementaldecoder(encoding)(errors="ignore")
+    text = [decoder.decode(piece) for piece in pieces]
+    text.append(decoder.decode(b"", final=True))
+    return "".join(text)
+
+# <FictionBook root (possibly namespace-prefixed) in all encodings we may
+# meet. Single-byte encodings are ASCII-compatible, so UTF-8 covers them
+_FB2_ROOTS = [(prefix + "FictionBook").encode(encoding) 
+    for encoding in ("UTF-8", "UTF-16-LE", "UTF-16-BE", "UTF-32-LE", 
+                     "UTF-32-BE")
+    for prefix in ("<", ":")]
+
+def sniff(data):
+    "Whether data (first _SNIFF_LEN bytes of a stream) looks like an FB2"
+    return _looks_like_fb2(data, len(data))
+
+def _looks_like_fb2(buffer, size):
+    for root in _FB2_ROOTS:
+        if buffer.find(root, 0, size) >= 0: return True
+    return False
+
+# Byte order marks. UTF-32-LE one starts with UTF-16-LE one, so goes first
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "UTF-32-LE"),
+    (codecs.BOM_UTF32_BE, "UTF-32-BE"),
+    (codecs.BOM_UTF8, "UTF-8"),
+    (codecs.BOM_UTF16_LE, "UTF-16-LE"),
+    (codecs.BOM_UTF16_BE, "UTF-16-BE"),
+)
+# "<?" of the xml declaration without BOM, see XML 1.0 appendix F
+_XML_DECLARATIONS = tuple(("<?".encode(encoding), encoding) 
+    for encoding in ("UTF-32-LE", "UTF-32-BE", "UTF-16-LE", "UTF-16-BE"))
+_DECLARED_ENCODING = re.compile(rb"""encoding=["']([A-Za-z0-9._:-]+)["']""")
+
+# Declared encodings which are often wrong, checked by byte statistics.
+# Both have Russian letters in 0xC0-0xFF, but lower case ones (much more
+# frequent in a text) are 0xE0-0xFF in cp1251 and 0xC0-0xDF in koi8-r
+_CYRILLIC_ENCODINGS = ("cp1251", "koi8-r")
+_DETECTION_LEN = 64*1024 # bytes to gather statistics from
+_MIN_LETTERS = 32 # don't trust statistics on fewer letters than this
+# Share of non-ASCII characters which may be broken in a UTF-8 file, more 
+# mean it is in a single-byte encoding
+_MAX_BAD_UTF8_SHARE = 0.1
+_NOT_LETTERS = bytes(range(0xC0))
+_LOWER_HALF_LETTERS = bytes(range(0xC0, 0xE0))
 
 def _determine_encoding(buffer, size):
+    """Encoding from BOM, or by the way "<?" is encoded, or from the xml 
+    declaration. Files declared as single-byte Russian encodings, UTF-8 or
+    nothing are read as UTF-8 first, and are checked by byte statistics only
+    if a noticeable share of their non-ASCII characters is broken"""
     ret = None
-    if size >= 4:
-        if buffer.startswith(codecs.BOM_UTF8):
-            ret = 'UTF-8'
-        elif buffer.startswith(codecs.BOM_UTF16_LE):
-            ret = 'UTF-16-LE'
-        elif buffer.startswith(codecs.BOM_UTF16_BE):
-            ret = 'UTF-16-BE'
-        elif buffer.startswith(codecs.BOM_UTF32_LE):
-            ret = 'UTF-32-LE'
-        elif buffer.startswith(codecs.BOM_UTF32_LE):
-            ret = 'UTF-32-LE'
-
+    for bom, encoding in _BOMS:
+        if buffer.startswith(bom, 0, size):
+            ret = encoding
+            break
+    else:
+        for declaration, encoding in _XML_DECLARATIONS:
+            if buffer.startswith(declaration, 0, size):
+                ret = encoding
+                break
     if not ret:
-        first_newline = buffer.find(b'\n', 0, size)
-        if first_newline > 0:
-            view = memoryview(buffer)
-            first_line = codecs.decode(view[:first_newline], "utf-8", 
-                errors="ignore")
-            encoding = _EXTRACT_ENCODING1.search(first_line)
-            if not encoding:
-                encoding = _EXTRACT_ENCODING2.search(first_line)
-            if encoding:
-                ret = encoding.group(1)
-                if ret.lower().startswith('windows-'): 
-                    ret = "cp"+ret[len('windows-'):]
+        declared = _declared_encoding(buffer, size)
+        if declared in _CYRILLIC_ENCODINGS + (None, "utf-8"):
+            sample = memoryview(buffer)[:min(size, _DETECTION_LEN)]
+            non_ascii, bad = _utf8_stats(sample)
+            if bad > non_ascii * _MAX_BAD_UTF8_SHARE:
+                ret = _guess_cyrillic(bytes(sample))
+            elif non_ascii and declared in _CYRILLIC_ENCODINGS:
+                ret = "utf-8" # (almost) valid UTF-8 and not just ASCII
+            if ret and declared and ret != declared:
+                _LOGGER.info("Declared encoding is %s, but looks like %s",
+                    declared, ret)
+        ret = ret or declared
     if ret:
         _LOGGER.info("Encoding is %s", ret)
         return ret
@@ -100,6 +214,47 @@ def _determine_encoding(buffer, size):
        _LOGGER.info("Could not determine the encoding, assuming UTF-8")
        return "UTF-8"
 
+def _declared_encoding(buffer, size):
+    "Python name of the encoding in <?xml ... ?> or None"
+    end = buffer.find(b"?>", 0, min(size, _SNIFF_LEN))
+    if end < 0: return None
+    match = _DECLARED_ENCODING.search(buffer, 0, end)
+    if not match: return None
+    name = match.group(1).decode("ascii")
+    try:
+        encoding = codecs.lookup(name).name
+    except LookupError:
+        _LOGGER.info("Unknown encoding %s", name)
+        return None
+    # We could read the declaration as ASCII, so it can't be UTF-16 etc
+    if "<".encode(encoding) != b"<": return None
+    return encoding
+
+def _utf8_stats(sample):
+    """(non-ASCII characters, broken ones) in sample read as UTF-8. sample 
+       may end in the middle of a character"""
+    text = codecs.utf_8_decode(sample, "replace", False)[0]
+    ascii = len(text.encode("ascii", "ignore"))
+    return len(text) - ascii, text.count("\ufffd")
+
+def _guess_cyrillic(sample):
+    "cp1251 or koi8-r from byte statistics, None if there are too few letters"
+    letters = sample.translate(None, _NOT_LETTERS)
+    if len(letters) < _MIN_LETTERS: return None
+    upper_half = len(letters.translate(None, _LOWER_HALF_LETTERS))
+    return "cp1251" if upper_half * 2 > len(letters) else "koi8-r"
+
+_ENCODED_TAGS = {}
+
+def _encoded_tags(encoding):
+    "(<description, </description>) in encoding"
+    tags = _ENCODED_TAGS.get(encoding)
+    if not tags:
+        tags = ("<description".encode(encoding), 
+            "</description>".encode(encoding))
+        _ENCODED_TAGS[encoding] = tags
+    return tags
+
 def _parse_description(xml, full_desc):
     book = None
     if full_desc:
@@ -154,7 +309,7 @@ def _parse_description_via_xml(xml):
     if not book.authors:
         document_info = desc.find("document-info")
         book.authors = _parse_authors(document_info)
-    book.metatext = _compact_whitespaces(_dump_text(desc, _MAX_METATEXT_LEN))
+    book.metatext = _dump_metatext(desc, _MAX_METATEXT_LEN)
 
     return book
 
@@ -269,43 +424,55 @@ def _first_int(root, conversion, *tags):
     return None
 
 def _dump_text(root, max_len):
+    "Stripped texts of root and its descendants joined by spaces, bounded"
     acc = BoundStringIO(max_len)
-    written = 0
-    empty = True
-    def _dump(node):
-        nonlocal acc
-        nonlocal empty
-        if acc.full() or node is None: return
-        text = _strip(node.text)
-        if text:
-            if empty:
-                empty = False
-            else:
-                acc.write(' ')
-            acc.write(text)
-        for child in node:
-            _dump(child)
-    _dump(root)
+    for text in _texts(root):
+        text = _strip(text)
+        if not text: continue
+        if acc.written(): acc.write(' ')
+        acc.write(text)
+        if acc.full(): break
     return acc.getvalue()
 
-def _make_tag_regexp(tag): 
-    return re.compile("<"+tag+"[ >](.*?)</"+tag+">", re.DOTALL)
-_BOOK_NAME_RE =_make_tag_regexp("book-name")
-_BOOK_TITLE_RE = _make_tag_regexp("book-title")
-_BOOK_YEAR_RE = _make_tag_regexp("year")
-_ISBN_YEAR_RE = _make_tag_regexp("isbn")
-_AUTHORS_RE = _make_tag_regexp("author")
-_DATE_RE = _make_tag_regexp("date")
-_ANNOTATION_RE = _make_tag_regexp("annotation")
+_WORD = re.compile(r"\S+")
+
+def _dump_metatext(root, max_len):
+    """Same as _compact_whitespaces(_dump_text(root, max_len)), but bound 
+    applies to the compacted text and nothing past it is looked at"""
+    acc = BoundStringIO(max_len)
+    for text in _texts(root):
+        for word in _WORD.finditer(text):
+            if acc.written(): acc.write(' ')
+            acc.write(word.group())
+            if acc.full(): return acc.getvalue()
+    return acc.getvalue()
+
+def _texts(root):
+    "node.text of root and its descendants in document order, no recursion"
+    stack = [] if root is None else [root]
+    while stack:
+        node = stack.pop()
+        if node.text: yield node.text
+        stack.extend(reversed(node))
+
+# Elements the regexp-based parser looks at. Unlike XML parser it does not
+# care about nesting, every element is looked for in the whole description
+_FIELD_TAGS = ("book-name", "book-title", "year", "date", "author", 
+    "annotation")
+# Opening <tag followed by space or >, or closing </tag>
+_FIELD_TAG_RE = re.compile("<(/)?(" + "|".join(_FIELD_TAGS) + ")(?(1)>|[ >])")
 
 def _parse_description_via_regexpes(xml):
+    spans = _find_field_spans(xml)
+    def texts(tag):
+        for start, end in spans[tag]: yield _remove_all_tags(xml[start:end])
     book = book_model.Book()
-    book.title = _find_first_tag_text(xml, _BOOK_NAME_RE)
-    book.authors = _find_all_tag_texts(xml, _AUTHORS_RE)
-    if not book.title: book.title = _find_first_tag_text(xml, _BOOK_TITLE_RE)
-    book.year = _find_first_tag_int(xml, _BOOK_YEAR_RE)
-    if not book.year: book.year =_find_first_tag_int(xml, _DATE_RE)
-    book.annotation = _find_first_tag_text(xml, _ANNOTATION_RE)
+    book.title = _first_non_empty(texts("book-name"))
+    book.authors = [text for text in texts("author") if text]
+    if not book.title: book.title = _first_non_empty(texts("book-title"))
+    book.year = _first_int_text(texts("year"))
+    if not book.year: book.year = _first_int_text(texts("date"))
+    book.annotation = _first_non_empty(texts("annotation"))
     if book.annotation and len(book.annotation) > _MAX_ANNOTATION_LEN:
         book.annotation = book.annotation[:_MAX_ANNOTATION_LEN]
     book.metatext = _remove_all_tags(xml)
@@ -313,50 +480,36 @@ def _parse_description_via_regexpes(xml):
         book.metatext = book.metatext[:_MAX_METATEXT_LEN:]
     return book
 
-def _find_all_tag_texts(xml, regexp):
-    result = []
-    pos = 0
-    match = regexp.search(xml, pos)
-    while match:
-        text = _remove_all_tags(match.group())
-        if text: result.append(text)
-        pos = match.end()
-        match = regexp.search(xml, pos)
-    return result
-
+def _find_field_spans(xml):
+    """Single pass over xml collecting {tag: [(start, end)]} of every 
+    <tag ...>...</tag> of _FIELD_TAGS. Element ends at the first closing tag
+    after its opening tag, openings in between are ignored, just like 
+    non-greedy "<tag[ >].*?</tag>" would do"""
+    spans = {tag: [] for tag in _FIELD_TAGS}
+    opened = {}
+    for match in _FIELD_TAG_RE.finditer(xml):
+        closing, tag = match.group(1, 2)
+        if not closing:
+            opened.setdefault(tag, match.start())
+        elif tag in opened:
+            spans[tag].append((opened.pop(tag), match.end()))
+    return spans
+
+def _first_non_empty(texts):
+    for text in texts:
+        if text: return text
+    return None
 
-def _find_first_tag_int(xml, regexp):
-    pos = 0
-    match = regexp.search(xml, pos)
-    while match:
-        text = _remove_all_tags(match.group())
-        if text: 
+def _first_int_text(texts):
+    for text in texts:
+        if text:
             try:
                 return int(text)
             except ValueError: pass
-        pos = match.end()
-        match = regexp.search(xml, pos)
-
-def _find_first_tag_text(xml, regexp):
-    pos = 0
-    match = regexp.search(xml, pos)
-    while match:
-        text = _remove_all_tags(match.group())
-        if text: return text
-        pos = match.end()
-        match = regexp.search(xml, pos)
+    return None
 
 def _remove_all_tags(text):
-    result = io.StringIO()
-    pos = 0
-    match = _LOOKS_LIKE_TAG.search(text, pos)
-    while match:
-        result.write(text[pos:match.start()])
-        pos = match.end()
-        match = _LOOKS_LIKE_TAG.search(text, pos)
-    end = len(text)
-    result.write(text[pos:])
-    return _compact_whitespaces(result.getvalue())
+    return _compact_whitespaces(_LOOKS_LIKE_TAG.sub("", text))
 
 def _strip(text):
     if text:
@@ -365,27 +518,66 @@ def _strip(text):
     else:
         return None
 
+_HASHING_POOL = None
+
+def _hashing_pool():
+    "Threads which update secondary digests, started on first use"
+    global _HASHING_POOL
+    if not _HASHING_POOL:
+        _HASHING_POOL = concurrent.futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="bookdesc-hash")
+    return _HASHING_POOL
+
+def _forget_hashing_pool():
+    # Threads do not survive fork(), the child has to start its own
+    global _HASHING_POOL
+    _HASHING_POOL = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_hashing_pool)
+
 class _ChecksumStream:
     def __init__(self, stream, buffer, *digests):
         self._buffer = buffer
         self._view = memoryview(buffer)
         self._stream = stream
+        self._total = 0
         self._digests = {}
         for digest in digests:
             self._digests[digest] = hashlib.new(digest)
-
-    def read(self):
-        """Read as much as possible into buffer and return number of bytes
-           read. Returns 0 or None when EOF"""
-        read = self._stream.readinto(self._buffer)
+        self._updaters = [d.update for d in self._digests.values()]
+
+    def read(self, start=0, stop=None):
+        """Read as much as possible into buffer[start:stop] and return number
+           of bytes read. Returns 0 when EOF"""
+        return self.read_into(self._view[start:stop])
+
+    def read_into(self, view):
+        """Read as much as possible into memoryview (not necessarily of our
+           buffer), return number of bytes read. readinto() of some streams
+           returns None instead of 0 when there is nothing to read"""
+        read = self._stream.readinto(view) or 0
         if read > 0: 
-            result = self._view[:read]
-            for digest in self._digests.values():
-                digest.update(result)
+            self._total += read
+            self._update(view[:read])
         return read
 
+    def _update(self, data):
+        first, *others = self._updaters
+        if others and _PARALLEL_HASHING and len(data) >= _PARALLEL_HASH_MIN:
+            pool = _hashing_pool()
+            futures = [pool.submit(update, data) for update in others]
+            first(data)
+            for future in futures: future.result()
+        else:
+            for update in self._updaters: update(data)
+
     def at_eof(self): return self._eof
 
+    def total(self):
+        "Return number of bytes read so far"
+        return self._total
+
     def digest(self, name):
         "Return current digest value for digest"
         return self._digests[name].digest()
@@ -411,4 +603,6 @@ class BoundStringIO:
 
     def full(self): return self._len == self._max_len
 
+    def written(self): return self._len
+
     def getvalue(self): return self._io.getvalue()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import codecs
+import hashlib
 import io
+import re
+import sys
+import xml.etree.ElementTree as ET
 
 import book_model
 import fb2_parser
@@ -25,6 +30,237 @@ class ParseFB2Test(unittest.TestCase):
         self.assertEqual("42a7319a2fb45842de56cc7336f63fca",
             book.file.md5.hex())
 
+    def test_size_is_counted(self):
+        with open("fb2-sample.fb2", "rb") as sample:
+            data = sample.read()
+        book = fb2_parser.parse(io.BytesIO(data))
+        self.assertEqual(len(data), book.file.size)
+
+    def test_sha256(self):
+        with open("fb2-sample.fb2", "rb") as sample:
+            data = sample.read()
+        book = fb2_parser.parse(io.BytesIO(data), sha256=True)
+        self.assertEqual(hashlib.sha256(data).digest(), book.file.sha256)
+        self.assertEqual(hashlib.sha1(data).digest(), book.file.sha1)
+
+    def test_digests_of_large_chunks(self):
+        data = bytes(range(256)) * (3 * fb2_parser._MEGABYTE // 256)
+        stream = fb2_parser._ChecksumStream(io.BytesIO(data), 
+            bytearray(fb2_parser._MEGABYTE), "sha1", "md5", "sha256")
+        parallel = fb2_parser._PARALLEL_HASHING
+        fb2_parser._PARALLEL_HASHING = True
+        try:
+            while stream.read(): pass
+        finally:
+            fb2_parser._PARALLEL_HASHING = parallel
+        self.assertEqual(hashlib.sha1(data).digest(), stream.digest("sha1"))
+        self.assertEqual(hashlib.md5(data).digest(), stream.digest("md5"))
+        self.assertEqual(hashlib.sha256(data).digest(), 
+            stream.digest("sha256"))
+        self.assertEqual(len(data), stream.total())
+
+    def test_readinto_returning_none(self):
+        class NoneAtEOF(io.BytesIO):
+            def readinto(self, view): return super().readinto(view) or None
+        with open("fb2-sample.fb2", "rb") as sample:
+            data = sample.read()
+        book = fb2_parser.parse(NoneAtEOF(data))
+        self.assertEqual(hashlib.sha1(data).digest(), book.file.sha1)
+        self.assertEqual(len(data), book.file.size)
+
+    def test_known_book_is_not_parsed(self):
+        with open("fb2-sample.fb2", "rb") as sample:
+            data = sample.read()
+        known = book_model.Book()
+        known.name = "Known"
+        asked = []
+        def find(sha1):
+            asked.append(sha1)
+            return known
+        book = fb2_parser.parse(io.BytesIO(data), known=find)
+        self.assertIs(known, book)
+        self.assertEqual([hashlib.sha1(data).digest()], asked)
+        self.assertEqual(hashlib.sha1(data).digest(), book.file.sha1)
+        self.assertEqual(hashlib.md5(data).digest(), book.file.md5)
+        self.assertEqual(len(data), book.file.size)
+
+    def test_unknown_book_is_parsed(self):
+        with open("fb2-sample.fb2", "rb") as sample:
+            book = fb2_parser.parse(sample, known=lambda sha1: None)
+        self.assertEqual("Тестовый платный документ FictionBook 2.1",
+            book.name)
+
+    def test_sniff_accepts_fb2(self):
+        with open("fb2-sample.fb2", "rb") as sample:
+            data = sample.read()
+        book = fb2_parser.parse(io.BytesIO(data), sniff=True)
+        self.assertEqual("eb0e0ec44a4f6f7bd6d837b5786ac4ec5d2b3cb9",
+            book.file.sha1.hex())
+
+    def test_sniff_accepts_utf16(self):
+        data = '<?xml version="1.0" encoding="UTF-16"?>\n<FictionBook>'
+        data = data.encode("UTF-16")
+        fb2_parser.parse(io.BytesIO(data), sniff=True)
+
+    def test_sniff_rejects_junk(self):
+        data = b"<?xml version='1.0'?>\n<html>" + b" " * 10000 + \
+            b"<FictionBook>"
+        with self.assertRaises(fb2_parser.NotFB2Error):
+            fb2_parser.parse(io.BytesIO(data), sniff=True)
+
+class ScanDescriptionTest(unittest.TestCase):
+    DESCRIPTION = ("<description><title-info><author><first-name>Иван"+
+        "</first-name><last-name>Петров</last-name></author><book-title>"+
+        "Книга</book-title></title-info></description>")
+
+    def _fb2(self, prefix_len, description=DESCRIPTION, encoding="utf-8"):
+        "FB2 with a stylesheet making <description start at prefix_len"
+        head = '<?xml version="1.0" encoding="%s"?>\n<FictionBook>' % \
+            encoding
+        head = head.encode(encoding)
+        unit = len("p".encode(encoding))
+        padding = (prefix_len - len(head)) // unit - \
+            len("<stylesheet></stylesheet>")
+        return head + ("<stylesheet>" + "p" * padding + "</stylesheet>" +
+            description + "<body>text</body></FictionBook>").encode(encoding)
+
+    def _parse(self, data):
+        book = fb2_parser.parse(io.BytesIO(data))
+        self.assertEqual(hashlib.sha1(data).digest(), book.file.sha1)
+        self.assertEqual(len(data), book.file.size)
+        return book
+
+    def test_start_tag_straddles_reads(self):
+        for shift in range(1, len("<description")):
+            book = self._parse(self._fb2(fb2_parser._MEGABYTE - shift))
+            self.assertEqual("Книга", book.name)
+            self.assertEqual(["Иван Петров"], book.authors)
+
+    def test_description_after_several_chunks(self):
+        book = self._parse(self._fb2(3 * fb2_parser._MEGABYTE + 5))
+        self.assertEqual("Книга", book.name)
+
+    def test_end_tag_straddles_reads(self):
+        end = len(self.DESCRIPTION.encode("utf-8"))
+        for shift in range(1, len("</description>")):
+            start = fb2_parser._MEGABYTE - end + shift
+            book = self._parse(self._fb2(start))
+            self.assertEqual("Книга", book.name)
+
+    def test_description_larger_than_buffer(self):
+        annotation = "<annotation>" + "а" * fb2_parser._MEGABYTE + \
+            "</annotation>"
+        description = self.DESCRIPTION.replace("</title-info>",
+            annotation + "</title-info>")
+        book = self._parse(self._fb2(1000, description))
+        self.assertEqual("Книга", book.name)
+        self.assertEqual(fb2_parser._MAX_ANNOTATION_LEN, len(book.annotation))
+
+    def test_utf16_end_tag_straddles_reads(self):
+        end = len(self.DESCRIPTION.encode("UTF-16-LE"))
+        data = codecs.BOM_UTF16_LE + self._fb2(
+            fb2_parser._MEGABYTE - end + 4 - len(codecs.BOM_UTF16_LE), 
+            encoding="UTF-16-LE")
+        book = self._parse(data)
+        self.assertEqual("Книга", book.name)
+
+    def test_no_description(self):
+        data = self._fb2(2 * fb2_parser._MEGABYTE, description="")
+        self.assertEqual(None, fb2_parser.parse(io.BytesIO(data)))
+
+class DetermineEncodingTest(unittest.TestCase):
+    TEXT = "<description><title-info><book-title>Война и мир</book-title>"+\
+        "<annotation>Роман-эпопея, описывающий русское общество в эпоху "+\
+        "войн против Наполеона</annotation></title-info></description>"
+
+    def _encoding(self, data):
+        return fb2_parser._determine_encoding(bytearray(data), len(data))
+
+    def _fb2(self, declared, encoding):
+        return ('<?xml version="1.0" encoding="%s"?>\n' % declared + 
+            self.TEXT).encode(encoding)
+
+    def test_boms(self):
+        for bom, encoding in ((codecs.BOM_UTF8, "UTF-8"), 
+                (codecs.BOM_UTF16_LE, "UTF-16-LE"), 
+                (codecs.BOM_UTF16_BE, "UTF-16-BE"),
+                (codecs.BOM_UTF32_LE, "UTF-32-LE"), 
+                (codecs.BOM_UTF32_BE, "UTF-32-BE")):
+            data = bom + self._fb2("UTF-16", encoding)
+            self.assertEqual(encoding, self._encoding(data))
+
+    def test_utf16_and_utf32_without_bom(self):
+        for encoding in ("UTF-16-LE", "UTF-16-BE", "UTF-32-LE", "UTF-32-BE"):
+            data = self._fb2("UTF-16", encoding)
+            self.assertEqual(encoding, self._encoding(data))
+
+    def test_declared(self):
+        self.assertEqual("cp1251", 
+            self._encoding(self._fb2("windows-1251", "cp1251")))
+        self.assertEqual("koi8-r", 
+            self._encoding(self._fb2("KOI8-R", "koi8-r")))
+        self.assertEqual("utf-8", self._encoding(self._fb2("utf-8", "utf-8")))
+        self.assertEqual("iso8859-5", 
+            self._encoding(self._fb2("ISO-8859-5", "iso8859-5")))
+
+    def test_mislabeled(self):
+        self.assertEqual("cp1251", 
+            self._encoding(self._fb2("koi8-r", "cp1251")))
+        self.assertEqual("koi8-r", 
+            self._encoding(self._fb2("windows-1251", "koi8-r")))
+        self.assertEqual("cp1251", 
+            self._encoding(self._fb2("utf-8", "cp1251")))
+        self.assertEqual("koi8-r", 
+            self._encoding(self._fb2("unknown-charset", "koi8-r")))
+        self.assertEqual("utf-8", 
+            self._encoding(self._fb2("windows-1251", "utf-8")))
+        self.assertEqual("utf-8", 
+            self._encoding(self._fb2("koi8-r", "utf-8")))
+
+    def test_utf8_with_a_broken_byte(self):
+        for declared in ("utf-8", "windows-1251", "koi8-r"):
+            data = self._fb2(declared, "utf-8").replace("мир".encode(), 
+                "мир".encode() + b"\xff")
+            self.assertEqual("utf-8", self._encoding(data))
+
+    def test_undeclared(self):
+        data = self.TEXT.encode("koi8-r")
+        self.assertEqual("koi8-r", self._encoding(data))
+        self.assertEqual("UTF-8", self._encoding(b"<FictionBook>"))
+
+    def test_encoded_tags_are_cached(self):
+        tags = fb2_parser._encoded_tags("UTF-32-BE")
+        self.assertEqual("<description".encode("UTF-32-BE"), tags[0])
+        self.assertIs(tags, fb2_parser._encoded_tags("UTF-32-BE"))
+
+    def test_parse_utf32_be(self):
+        data = codecs.BOM_UTF32_BE + self._fb2("UTF-32", "UTF-32-BE")
+        book = fb2_parser.parse(io.BytesIO(data))
+        self.assertEqual("Война и мир", book.name)
+
+    def test_parse_mislabeled(self):
+        book = fb2_parser.parse(io.BytesIO(self._fb2("koi8-r", "cp1251")))
+        self.assertEqual("Война и мир", book.name)
+
+class DumpTextTest(unittest.TestCase):
+    def test_metatext_is_compacted_text(self):
+        xml = ET.fromstring("<d> a  <b>\n b\tb <c/></b><c> c </c>\n</d>")
+        self.assertEqual("a b b c", fb2_parser._dump_metatext(xml, 100))
+        self.assertEqual("a b\tb c", fb2_parser._dump_text(xml, 100))
+
+    def test_metatext_is_bounded_after_compacting(self):
+        xml = ET.fromstring("<d>" + "word     " * 10000 + "</d>")
+        metatext = fb2_parser._dump_metatext(xml, 100)
+        self.assertEqual(("word " * 20)[:100], metatext)
+
+    def test_deep_tree(self):
+        depth = sys.getrecursionlimit() + 100
+        xml = "<description>" + "<p>x" * depth + "</p>" * depth + \
+            "</description>"
+        book = fb2_parser._parse_description_via_xml(xml)
+        self.assertEqual(
+            " ".join(["x"] * depth)[:fb2_parser._MAX_METATEXT_LEN],
+            book.metatext)
 
 class ParseDescriptionTest(unittest.TestCase):
 
@@ -295,6 +531,82 @@ HEA 1989, ISBN 9635713142 -->
         book = fb2_parser._parse_description(s.getvalue(), True)
         self.assertTrue(len(book.annotation) <= fb2_parser._MAX_ANNOTATION_LEN)
         self.assertTrue(len(book.metatext) <= fb2_parser._MAX_METATEXT_LEN)
+
+# Regexp-based parser as it was before the single pass one, for the 
+# equivalence test
+def _legacy_tag_regexp(tag): 
+    return re.compile("<"+tag+"[ >](.*?)</"+tag+">", re.DOTALL)
+
+def _legacy_texts(xml, regexp):
+    for match in regexp.finditer(xml):
+        yield _legacy_remove_all_tags(match.group())
+
+def _legacy_first_text(xml, regexp):
+    for text in _legacy_texts(xml, regexp):
+        if text: return text
+
+def _legacy_first_int(xml, regexp):
+    for text in _legacy_texts(xml, regexp):
+        if text: 
+            try:
+                return int(text)
+            except ValueError: pass
+
+def _legacy_remove_all_tags(text):
+    result = io.StringIO()
+    pos = 0
+    match = fb2_parser._LOOKS_LIKE_TAG.search(text, pos)
+    while match:
+        result.write(text[pos:match.start()])
+        pos = match.end()
+        match = fb2_parser._LOOKS_LIKE_TAG.search(text, pos)
+    result.write(text[pos:])
+    return fb2_parser._compact_whitespaces(result.getvalue())
+
+def _legacy_parse_description_via_regexpes(xml):
+    book = book_model.Book()
+    book.title = _legacy_first_text(xml, _legacy_tag_regexp("book-name"))
+    book.authors = [text for text in 
+        _legacy_texts(xml, _legacy_tag_regexp("author")) if text]
+    if not book.title: 
+        book.title = _legacy_first_text(xml, _legacy_tag_regexp("book-title"))
+    book.year = _legacy_first_int(xml, _legacy_tag_regexp("year"))
+    if not book.year: 
+        book.year = _legacy_first_int(xml, _legacy_tag_regexp("date"))
+    book.annotation = _legacy_first_text(xml, _legacy_tag_regexp("annotation"))
+    if book.annotation and len(book.annotation) > fb2_parser._MAX_ANNOTATION_LEN:
+        book.annotation = book.annotation[:fb2_parser._MAX_ANNOTATION_LEN]
+    book.metatext = _legacy_remove_all_tags(xml)
+    if book.metatext and len(book.metatext) > fb2_parser._MAX_METATEXT_LEN:
+        book.metatext = book.metatext[:fb2_parser._MAX_METATEXT_LEN:]
+    return book
+
+class RegexpParserEquivalenceTest(unittest.TestCase):
+    def _corpus(self):
+        "Description of the sample and its damaged variants"
+        with open("fb2-sample.fb2", "rb") as sample:
+            data = sample.read().decode("cp1251")
+        start = data.index("<description")
+        end = data.index("</description>") + len("</description>")
+        description = data[start:end]
+        nested = description.replace("<annotation>", 
+            "<annotation><author>inside</author><book-name>", 1)
+        for xml in (description, nested, description.replace(">", " ", 7),
+                description.replace("</author>", "", 1), 
+                description.replace("<year>", "<year x='1'>")):
+            for length in range(0, len(xml), 37):
+                yield xml[:length]
+                yield xml[length:]
+
+    def test_same_as_legacy(self):
+        fields = ("title", "authors", "year", "annotation", "metatext")
+        for xml in self._corpus():
+            expected = _legacy_parse_description_via_regexpes(xml)
+            actual = fb2_parser._parse_description_via_regexpes(xml)
+            for field in fields:
+                self.assertEqual(getattr(expected, field), 
+                    getattr(actual, field), field + " of " + repr(xml))
+
 if __name__ == '__main__':
     unittest.main()
 
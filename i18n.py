@@ -1,26 +1,30 @@
 # -*- coding: UTF-8 -*-
 """Internatialization support"""
 
-import bookdesc
-import locale
-
 def _major_locale():
+    import locale
     loc = locale.getlocale()[0]
+    if not loc: return ''
     underscore = loc.find('_')
     if underscore > 0:
         loc = loc[:underscore]
     return loc
 
 
-_MAJOR_LOCALE = _major_locale()
+_MAJOR_LOCALE = None # detected on first translate()
 _TRANSLATIONS = {}
     
-def translate(phrase):
+def translate(phrase, default=None):
+    """Translate phrase to the current locale. Falls back to the '' 
+       translation, then to default, then to phrase itself"""
+    global _MAJOR_LOCALE
+    if _MAJOR_LOCALE is None: _MAJOR_LOCALE = _major_locale()
     text = None
     phrase_translations = _TRANSLATIONS.get(phrase)
     if phrase_translations:
         text = phrase_translations.get(_MAJOR_LOCALE)
         if not text: text = phrase_translations.get('')
+    if not text: text = default
     if not text: text = phrase
     return text
 
@@ -40,6 +44,93 @@ _TRANSLATIONS['Display program infomration (long)'] = {
 _TRANSLATIONS['dedup backend (default:'] = {
     'ru': "backend для дедупликации (по умолчанию:"
 }
+_TRANSLATIONS['number of worker processes for .zip archives'] = {
+    'ru': "количество рабочих процессов для .zip архивов"
+}
+_TRANSLATIONS['(default: 1)'] = {
+    'ru': "(по умолчанию: 1)"
+}
+_TRANSLATIONS['ASYNC_OPENS'] = {
+    '': "read up to N files at once, for network storage (default: 0, "+\
+        "read one file at a time)",
+    'ru': "читать до N файлов одновременно, для сетевых хранилищ "+\
+        "(по умолчанию: 0, читать по одному файлу)"
+}
+_TRANSLATIONS['read buffer size in megabytes'] = {
+    'ru': "размер буфера чтения в мегабайтах"
+}
+_TRANSLATIONS['buffer size must be at least 1 megabyte'] = {
+    'ru': "размер буфера должен быть не менее 1 мегабайта"
+}
+_TRANSLATIONS['also compute SHA-256 and write SHA256 column'] = {
+    'ru': "также вычислять SHA-256 и записывать колонку SHA256"
+}
+_TRANSLATIONS['PRUNE_MISSING'] = {
+    '': "remove books whose files no longer exist from indexes and CSVs",
+    'ru': "удалить из индексов и CSV книги, файлов которых больше нет"
+}
+_TRANSLATIONS['CSV file format (default: gzip)'] = {
+    'ru': "формат CSV файлов (по умолчанию: gzip)"
+}
+_TRANSLATIONS['OFFSETS'] = {
+    '': "write .offsets tables next to plain CSVs for fast lookup by SHA1",
+    'ru': "записывать таблицы .offsets рядом с несжатыми CSV для быстрого "+\
+        "поиска по SHA1"
+}
+_TRANSLATIONS['DUPLICATES'] = {
+    '': "print CSV with all paths of books found under several paths",
+    'ru': "вывести CSV со всеми путями книг, найденных по нескольким путям"
+}
+_TRANSLATIONS['REBUILD_ALL'] = {
+    '': "before parsing, rebuild indexes of all changed CSVs in --jobs "+\
+        "processes instead of one by one when they are touched",
+    'ru': "перед разбором перестроить индексы всех изменённых CSV в "+\
+        "--jobs процессах, а не по одному при обращении"
+}
+_TRANSLATIONS['DAEMON'] = {
+    '': "after parsing INPUTs, keep running and accept paths to parse on "+\
+        "Unix socket SOCKET",
+    'ru': "после разбора INPUT продолжать работу и принимать пути для "+\
+        "разбора через Unix сокет SOCKET"
+}
+_TRANSLATIONS['DEBOUNCE'] = {
+    '': "in daemon mode, rebuild CSVs after SECONDS without new paths "+\
+        "(default: 2)",
+    'ru': "в режиме демона перестраивать CSV, если новых путей не было "+\
+        "SECONDS секунд (по умолчанию: 2)"
+}
+_TRANSLATIONS['CONNECT'] = {
+    '': "send OUT and INPUTs to the daemon listening on SOCKET and exit",
+    'ru': "отправить OUT и INPUT демону, слушающему SOCKET, и выйти"
+}
+_TRANSLATIONS["--daemon can't be used in dumb mode"] = {
+    'ru': "--daemon нельзя использовать в тупом режиме"
+}
+_TRANSLATIONS['WATCH'] = {
+    '': "after parsing INPUTs, keep watching INPUT folders and parse new "+\
+        "and changed files",
+    'ru': "после разбора INPUT продолжать следить за каталогами INPUT и "+\
+        "разбирать новые и измененные файлы"
+}
+_TRANSLATIONS['how to watch folders (default: auto)'] = {
+    'ru': "как следить за каталогами (по умолчанию: auto)"
+}
+_TRANSLATIONS['POLL_INTERVAL'] = {
+    '': "seconds between scans of poll watcher (default: 5)",
+    'ru': "секунд между просмотрами каталогов для poll (по умолчанию: 5)"
+}
+_TRANSLATIONS['WATCH_NEEDS_FOLDERS'] = {
+    '': "--watch needs at least one INPUT folder and can't be used with "+\
+        "--daemon",
+    'ru': "для --watch нужен хотя бы один каталог INPUT, и его нельзя "+\
+        "использовать вместе с --daemon"
+}
+_TRANSLATIONS['at least one INPUT is required'] = {
+    'ru': "требуется хотя бы один INPUT"
+}
+_TRANSLATIONS['--offsets requires --format plain or gzip-blocks'] = {
+    'ru': "--offsets требует --format plain или gzip-blocks"
+}
 _TRANSLATIONS['COWARD_MODE'] = {
     '': 'coward mode: fail on any WARNING/ERROR/CRITICAL message',
     'ru': "режим труса: аварийный выход при любом WARNING/ERROR/CRITICAL сообщении"
@@ -73,8 +164,8 @@ There are two main modes in which this tool works:
 """
 }
 
+# '' translation is bookdesc.__doc__, passed in as default
 _TRANSLATIONS["BOOKDESC_INFO"] = {
-    '': bookdesc.__doc__,
     'ru': """Генератор метаинформации для электронных книг.
 
 h1. История возникновения
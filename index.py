@@ -1,43 +1,120 @@
 # -*- coding: UTF-8 -*-
 """On-disk index for books.
 Implemented as simple on-disk key-value DB that provides very simple functions:
-1) save/update the book in the index
-2) List all books in the index
+1) save/update/delete the book in the index
+2) List all books in the index (ordered by sha1) or books with sha1 prefix
 3) put/get additional metadata objects (they MUST be pickleable)
+
+Saved books are written in batches. When a book is saved under a path other
+than the one already indexed for its sha1, the other paths are kept in
+book.duplicates. The check for an already indexed book is done once per 
+batch, in sha1 order, rather than on every save, and is skipped altogether 
+for sha1s which the index Bloom filter has never seen. 
+
+The filter is kept in index metadata between runs and is only loaded when
+needed. It is removed from there when the first new sha1 is added and written
+back on close, so an index which was not closed properly gets its filter 
+rebuilt from the keys, while opening an index and adding nothing to it 
+writes nothing.
 """
 
+import bloom
 import hashlib
 import pickle
 import keyvalue
 
 _META_PREFIX=b'meta_'
+_BATCH_SIZE=1024
 
 class Index:
     def __init__(self, filepath, idx_backend=keyvalue.open):
         "Open/create a new index backed by file at filepath"
         self._filepath = filepath
         self._db = idx_backend(self._filepath)
+        self._pending = {} # sha1 -> pickled book
+        self._bloom = None # see _filter()
+        self._bloom_changed = False
 
     def close(self):
         "Close the index. MUST be called after use, but only once"
+        self.flush()
+        if self._bloom_changed: self.set("bloom", self._bloom)
         self._db.close()
 
     def __enter__(self): return self
     def __exit__(self, type, value, traceback): self.close()
 
     def save(self, book):
-        "Put book into the index"
-        sha1 = book.file.sha1
-        pickled = pickle.dumps(book)
-        self._db[sha1] = pickled
+        "Put book into the index. It is written by the next flush()"
+        sha1, pickled = book.file.sha1, pickle.dumps(book)
+        previous = self._pending.get(sha1)
+        self._pending[sha1] = _merge_paths(pickled, previous) if previous \
+            else pickled
+        if len(self._pending) >= _BATCH_SIZE: self.flush()
+
+    def flush(self):
+        """Write saved books, keeping other known paths of their sha1 in
+           book.duplicates"""
+        if not self._pending: return
+        batch = self._pending
+        self._pending = {}
+        for sha1 in sorted(batch):
+            pickled = batch[sha1]
+            if sha1 in self._filter():
+                previous = self._db.get(sha1)
+                if previous: pickled = _merge_paths(pickled, previous)
+            else:
+                self._add_to_filter(sha1)
+            self._db[sha1] = pickled
+
+    def contains(self, sha1):
+        "Whether the book is in the index. Most new books are not looked up"
+        self.flush()
+        return sha1 in self._filter() and self._db.get(sha1) is not None
+
+    def load(self, sha1):
+        "Return the book with sha1 or None. Most new books are not looked up"
+        if sha1 in self._pending: self.flush()
+        if sha1 not in self._filter(): return None
+        pickled = self._db.get(sha1)
+        return pickle.loads(pickled) if pickled else None
+
+    def replace(self, book):
+        "Write book as is, dropping paths known before"
+        self.flush()
+        if book.file.sha1 not in self._filter(): 
+            self._add_to_filter(book.file.sha1)
+        self._db[book.file.sha1] = pickle.dumps(book)
+
+    def delete(self, sha1):
+        "Remove book with given sha1 from the index"
+        self.flush()
+        del self._db[sha1]
+
+    def compact(self, drop=()):
+        """Give back space left by deleted and overwritten books, deleting
+           books with sha1s in drop on the way"""
+        self.flush()
+        self._db.compact(drop)
 
     def list(self):
-        "Return a generator which will iterate over all books in the index"
-        for key, maybe_book in self._db.items():
+        """Return a generator which will iterate over all books in the index
+           in sha1 order"""
+        self.flush()
+        # Book keys are raw sha1 which sort on both sides of metadata keys,
+        # so scan around the metadata range instead of checking every key
+        for _, pickled_book in self._db.range(None, _META_PREFIX):
+            yield pickle.loads(pickled_book)
+        after_meta = keyvalue.prefix_end(_META_PREFIX)
+        for _, pickled_book in self._db.range(after_meta, None):
+            yield pickle.loads(pickled_book)
+
+    def find(self, sha1_prefix):
+        "Return a generator over books whose sha1 starts with sha1_prefix"
+        self.flush()
+        for key, pickled_book in self._db.prefix(sha1_prefix):
             if not key.startswith(_META_PREFIX):
-                pickled_book = maybe_book
-                book = pickle.loads(pickled_book)
-                yield book
+                yield pickle.loads(pickled_book)
 
     def set(self, key, pickleable_value):
         "Set pickleable metadata value. Key should be a string"
@@ -51,11 +128,62 @@ class Index:
         pickled = self._db.get(fullkey)
         return pickle.loads(pickled) if pickled else None
 
-    def _fullkey(self, key): 
-        if type(key) != type(""): raise ValueError("key " + key(key) + \
-            " is not a string (type(key)==" + str(type(key)) + ")")
+    def _filter(self):
+        "Bloom filter of book keys, loaded or rebuilt on first use"
+        if self._bloom is None:
+            self._bloom = self.get("bloom")
+            if self._bloom is None:
+                self._bloom = self._build_bloom()
+                self._bloom_changed = True
+        return self._bloom
+
+    def _add_to_filter(self, sha1):
+        if not self._bloom_changed:
+            # stored filter is stale until close(), drop it in case we die
+            del self._db[self._fullkey("bloom")]
+            self._bloom_changed = True
+        self._bloom.add(sha1)
+
+    def _build_bloom(self):
+        result = bloom.BloomFilter()
+        for key in self._db.keys():
+            if not key.startswith(_META_PREFIX): result.add(key)
+        return result
+
+    def _fullkey(self, key): return _meta_key(key)
+
+def read_meta(filepath, key, idx_backend=keyvalue.open):
+    """Get one metadata value of the index at filepath without opening it as
+       an Index"""
+    with idx_backend(filepath) as db:
+        pickled = db.get(_meta_key(key))
+        return pickle.loads(pickled) if pickled else None
+
+def _meta_key(key):
+    if type(key) != type(""): raise ValueError("key " + key(key) + \
+        " is not a string (type(key)==" + str(type(key)) + ")")
+
+    # ensure we never overlap those keys with sha1 book keys
+    b = bytearray(_META_PREFIX)
+    b.extend(key.encode('utf-8'))
+    return bytes(b)
+
+def paths(book):
+    "All known paths of the book, the primary one first"
+    result = [book.file.path] if book.file.path else []
+    for path in getattr(book, "duplicates", None) or ():
+        if path not in result: result.append(path)
+    return result
 
-        # ensure we never overlap those keys with sha1 book keys
-        b = bytearray(_META_PREFIX)
-        b.extend(key.encode('utf-8'))
-        return bytes(b)
+def _merge_paths(pickled, previous):
+    """Keep paths of the previous version of the book as duplicates of the 
+       book, both are pickled. Return pickled book"""
+    if pickled == previous: return pickled
+    book = pickle.loads(pickled)
+    duplicates = paths(book)[1:]
+    for path in paths(pickle.loads(previous)):
+        if path != book.file.path and path not in duplicates:
+            duplicates.append(path)
+    if duplicates == getattr(book, "duplicates", None): return pickled
+    book.duplicates = duplicates
+    return pickle.dumps(book)
@@ -5,6 +5,7 @@ import book_model
 import keyvalue
 import index
 import unittest
+from test_helpers import KeptDb
 
        
 
@@ -46,7 +47,7 @@ class IndexTest(unittest.TestCase):
         self.book1.name = "A book"
         self.book1.file = book_model.File()
         self.book1.file.sha1 = b'01'
-        self.db = keyvalue.open('', backend="memory")
+        self.db = KeptDb('')
         self.open_fixture()
 
     def open_fixture(self):
@@ -72,6 +73,97 @@ class IndexTest(unittest.TestCase):
         self.assertEqual(1, len(all))
         self.assertEqual(book.name, all[0].name)
 
+    def test_delete(self):
+        book = self.book1
+        self.fixture.save(book)
+        self.fixture.delete(book.file.sha1)
+        self.fixture.compact()
+        self.assertEqual(0, len(list(self.fixture.list())))
+
+    def test_read_meta(self):
+        self.fixture.set("mtime", (1, 2))
+        self.fixture.close()
+        self.assertEqual((1, 2), 
+            index.read_meta("file", "mtime", idx_backend=lambda f: self.db))
+        self.assertIsNone(index.read_meta("file", "missing", 
+            idx_backend=lambda f: self.db))
+        self.open_fixture()
+
+    def test_duplicate_paths(self):
+        self.book1.file.path = "/a.fb2"
+        self.fixture.save(self.book1)
+        self.fixture.save(self.book1)
+        self.fixture.flush()
+        self.book1.file.path = "/b.fb2"
+        self.fixture.save(self.book1)
+        self.book1.file.path = "/c.fb2"
+        self.fixture.save(self.book1)
+        got = list(self.fixture.list())
+        self.assertEqual(1, len(got))
+        self.assertEqual("/c.fb2", got[0].file.path)
+        self.assertEqual(["/c.fb2", "/b.fb2", "/a.fb2"], index.paths(got[0]))
+
+    def test_contains(self):
+        self.fixture.save(self.book1)
+        self.assertTrue(self.fixture.contains(self.book1.file.sha1))
+        self.assertFalse(self.fixture.contains(b'02'))
+
+    def test_load(self):
+        self.fixture.save(self.book1)
+        self.assertEqual("A book", self.fixture.load(b'01').name)
+        self.assertEqual("A book", self.fixture.load(b'01').name)
+        self.assertEqual(None, self.fixture.load(b'02'))
+
+    def test_bloom_filter_is_persisted(self):
+        self.fixture.save(self.book1)
+        self.fixture.close()
+        self.assertIsNotNone(self.db.get(b'meta_bloom'))
+        self.open_fixture()
+        self.assertTrue(b'01' in self.fixture._filter())
+        self.assertTrue(self.fixture.contains(b'01'))
+
+    def test_bloom_filter_is_rebuilt_if_not_closed(self):
+        self.fixture.save(self.book1)
+        self.fixture.close()
+        self.open_fixture()
+        self.book1.file.sha1 = b'02'
+        self.fixture.save(self.book1)
+        self.fixture.flush()
+        self.open_fixture() # as if the process died
+        self.assertTrue(b'02' in self.fixture._filter())
+        self.assertTrue(self.fixture.contains(b'02'))
+
+    def test_bloom_filter_is_not_rewritten_if_unchanged(self):
+        self.fixture.save(self.book1)
+        self.fixture.close()
+        stored = self.db.get(b'meta_bloom')
+        self.open_fixture()
+        self.assertEqual(1, len(list(self.fixture.list())))
+        self.assertIsNone(self.fixture._bloom)
+        self.fixture.save(self.book1)
+        self.fixture.close()
+        self.assertIs(stored, self.db.get(b'meta_bloom'))
+        self.open_fixture()
+
+    def test_list_is_ordered_and_skips_metadata(self):
+        for sha1 in (b'\xff\x01', b'meta', b'\x00\x02', b'meta_x', b'mf'):
+            book = book_model.Book()
+            book.file = book_model.File()
+            book.file.sha1 = sha1
+            self.fixture.save(book)
+        self.fixture.set("key", "value")
+        got = [book.file.sha1 for book in self.fixture.list()]
+        self.assertEqual([b'\x00\x02', b'meta', b'mf', b'\xff\x01'], got)
+
+    def test_find_by_prefix(self):
+        for sha1 in (b'\x01\x02', b'\x01\xff', b'\x02\x00'):
+            book = book_model.Book()
+            book.file = book_model.File()
+            book.file.sha1 = sha1
+            self.fixture.save(book)
+        got = [book.file.sha1 for book in self.fixture.find(b'\x01')]
+        self.assertEqual([b'\x01\x02', b'\x01\xff'], got)
+
     def test_set_put_metadata(self):
         self.fixture.set("key", "value")
         self.assertEqual("value", self.fixture.get("key"))
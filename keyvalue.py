@@ -1,28 +1,105 @@
 # -*- coding: UTF-8 -*-
-"""Provides access to best k-v store available"""
+"""Provides access to best k-v store available.
 
+Besides dict-like access and keys() (in no particular order), every backend
+provides ordered scans:
+range(start, stop) yields (key, value) for start <= key < stop in key order
+(None means unbounded), prefix(p) yields keys starting with p. dumb, memory
+and packed backends are not ordered and emulate scans by sorting keys.
+
+memory and packed backends keep data in this process only and lose it on 
+close(). packed keeps values in a few large arenas instead of a bytes object
+per value and spills values to a temporary file once PACKED_MEMORY_BUDGET is
+used up.
+
+compact(drop) gives back space of deleted and overwritten values, deleting
+keys in drop on the way (faster than deleting many keys one by one).
+
+Backend implementations (bplustreebranded, dbm.dumb) are imported when the
+backend is opened, so importing keyvalue is cheap"""
+
+import array
 import log
-import dbm.dumb # ndbm has serious problems with large number od keys
-import bplustreebranded
-from bplustreebranded import serializer
+import os
+import os.path
 
 _BACKENDS = {}
 
-class BytesSerializer(serializer.Serializer):
-    def serialize(self, obj : bytes , key_size: int) -> bytes:
-        assert len(obj) <= key_size
-        return obj
+def prefix_end(prefix):
+    """Return the smallest key greater than all keys starting with prefix or
+       None if there is no such key (prefix is all 0xff bytes)"""
+    stripped = prefix.rstrip(b'\xff')
+    if not stripped: return None
+    return stripped[:-1] + bytes((stripped[-1] + 1,))
+
+def _in_range(key, start, stop):
+    return (start is None or start <= key) and (stop is None or key < stop)
 
-    def deserialize(self, data: bytes) -> bytes:
-        return data
+_BYTES_SERIALIZER = None
 
-def _bplustree(path):
-    return bplustreebranded.BPlusTree(path, 
-        serializer=BytesSerializer(),
-        key_size=20,
-        page_size=4096*4)
+def _bytes_serializer():
+    "Serializer of bytes keys, defined on first use as bplustree is heavy"
+    global _BYTES_SERIALIZER
+    if _BYTES_SERIALIZER: return _BYTES_SERIALIZER
+    from bplustreebranded import serializer
+
+    class BytesSerializer(serializer.Serializer):
+        def serialize(self, obj : bytes , key_size: int) -> bytes:
+            assert len(obj) <= key_size
+            return obj
+
+        def deserialize(self, data: bytes) -> bytes:
+            return data
+
+    _BYTES_SERIALIZER = BytesSerializer()
+    return _BYTES_SERIALIZER
+
+class BPlusTreeDb:
+    def __init__(self, path):
+        import bplustreebranded
+        self._tree = bplustreebranded.BPlusTree(path, 
+            serializer=_bytes_serializer(),
+            key_size=20,
+            page_size=4096*4)
+
+    def __setitem__(self, key, value):
+        self._tree[key] = value
+
+    def __getitem__(self, key):
+        return self._tree[key]
+
+    def __delitem__(self, key):
+        self._tree.delete(key)
+
+    def get(self, key):
+        return self._tree.get(key)
+
+    def items(self):
+        return self._tree.items()
 
-_BACKENDS["b+tree"] = _bplustree
+    def keys(self):
+        return self._tree.keys()
+
+    def range(self, start=None, stop=None):
+        if start is not None and stop is not None and start >= stop:
+            return iter(())
+        return self._tree.items(slice(start, stop))
+
+    def prefix(self, prefix):
+        return self.range(prefix, prefix_end(prefix))
+
+    def compact(self, drop=()):
+        """Rewrite the tree densely without keys in drop, giving freed pages
+           back to the OS"""
+        self._tree.compact(set(drop))
+
+    def close(self):
+        self._tree.close()
+ 
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+_BACKENDS["b+tree"] = BPlusTreeDb
 
 class InMemoryDb:
     def __init__(self, path):
@@ -40,23 +117,197 @@ class InMemoryDb:
     def get(self, key):
         return self.db.get(key)
 
+    def __delitem__(self, key):
+        del self.db[key]
+
     def items(self):
         return self.db.items()
 
+    def keys(self):
+        return self.db.keys()
+
+    def range(self, start=None, stop=None):
+        keys = sorted(k for k in self.db.keys() if _in_range(k, start, stop))
+        for key in keys:
+            yield key, self.db[key]
+
+    def prefix(self, prefix):
+        return self.range(prefix, prefix_end(prefix))
+
+    def compact(self, drop=()):
+        for key in drop:
+            del self.db[key]
+
     def close(self):
-        self._db = {}
+        self.db = {}
         self.closed = True
  
     def __enter__(self): return self
     def __exit__(self, type, value, traceback): self.close()
 
+# Bytes of values packed backend keeps in memory before spilling to disk
+PACKED_MEMORY_BUDGET = 256*1024*1024
+_ARENA_SIZE = 16*1024*1024
+# Arena number of values spilled to disk
+_SPILLED = -1
+# Live values are repacked instead of spilling once overwritten and deleted
+# ones take this share of the budget
+_DEAD_SHARE = 0.25
+
+class PackedDb:
+    def __init__(self, path, budget=None):
+        """@param budget Bytes of values to keep in memory, 
+                  PACKED_MEMORY_BUDGET by default"""
+        self.path = path
+        self._budget = PACKED_MEMORY_BUDGET if budget is None else budget
+        self._clear()
+        self.closed = False
+
+    def _clear(self):
+        self._slots = {} # key -> slot in arrays below
+        self._free = [] # slots of deleted keys
+        self._arena = array.array('l') # arena number or _SPILLED
+        self._offset = array.array('Q')
+        self._length = array.array('L')
+        self._arenas = []
+        self._used = 0 # bytes of live values in arenas
+        self._dead = 0 # bytes of overwritten and deleted values in arenas
+        self._spill = None
+        self._spill_size = 0
+
+    def __setitem__(self, key, value):
+        assert type(key) == type(b'')
+        # the old value must be dead before _append() may compact
+        if key in self._slots: del self[key]
+        arena, offset = self._append(value)
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._arena)
+            self._arena.append(0)
+            self._offset.append(0)
+            self._length.append(0)
+        self._slots[key] = slot
+        self._arena[slot] = arena
+        self._offset[slot] = offset
+        self._length[slot] = len(value)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None: raise KeyError(key)
+        return value
+
+    def get(self, key):
+        slot = self._slots.get(key)
+        if slot is None: return None
+        arena = self._arena[slot]
+        offset = self._offset[slot]
+        length = self._length[slot]
+        if arena == _SPILLED:
+            return os.pread(self._spill.fileno(), length, offset)
+        return bytes(self._arenas[arena][offset:offset+length])
+
+    def __delitem__(self, key):
+        slot = self._slots.pop(key)
+        self._release(slot)
+        self._free.append(slot)
+
+    def _release(self, slot):
+        "Value in slot is dead, its bytes stay in the arena till compact()"
+        if self._arena[slot] != _SPILLED: 
+            self._used -= self._length[slot]
+            self._dead += self._length[slot]
+
+    def items(self):
+        for key in list(self._slots.keys()):
+            yield key, self.get(key)
+
+    def keys(self):
+        return self._slots.keys()
+
+    def range(self, start=None, stop=None):
+        keys = sorted(k for k in self._slots.keys() if _in_range(k, start, stop))
+        for key in keys:
+            yield key, self.get(key)
+
+    def prefix(self, prefix):
+        return self.range(prefix, prefix_end(prefix))
+
+    def compact(self, drop=()):
+        """Repack live values except keys in drop, dropping deleted and 
+           overwritten ones"""
+        for key in drop:
+            del self[key]
+        old_arenas, old_spill = self._arenas, self._spill
+        self._arenas, self._used, self._dead = [], 0, 0
+        self._spill, self._spill_size = None, 0
+        by_arena = {}
+        for slot in self._slots.values():
+            by_arena.setdefault(self._arena[slot], []).append(slot)
+        # Arena by arena, freeing each once copied, so at most one old arena
+        # is kept besides the new ones. Spilled values go last and get back
+        # in memory if freed budget allows
+        for arena in sorted(by_arena, key=lambda a: a == _SPILLED):
+            for slot in by_arena.pop(arena):
+                offset, length = self._offset[slot], self._length[slot]
+                if arena == _SPILLED:
+                    value = os.pread(old_spill.fileno(), length, offset)
+                else:
+                    value = old_arenas[arena][offset:offset+length]
+                self._arena[slot], self._offset[slot] = self._append(value)
+            if arena != _SPILLED: old_arenas[arena] = None
+        if old_spill: old_spill.close()
+
+    def close(self):
+        if self._spill: self._spill.close()
+        self._clear()
+        self.closed = True
+
+    def _append(self, value):
+        """Store value bytes, return (arena, offset). Dead bytes count against
+           the budget, so they are compacted away rather than spilling once
+           there are enough of them"""
+        length = len(value)
+        if self._used + self._dead + length > self._budget and \
+                self._dead > self._budget * _DEAD_SHARE:
+            self.compact()
+        if self._used + self._dead + length > self._budget:
+            if not self._spill:
+                import tempfile
+                self._spill = tempfile.TemporaryFile(buffering=0)
+            offset = self._spill_size
+            os.pwrite(self._spill.fileno(), value, offset)
+            self._spill_size += length
+            return _SPILLED, offset
+        if not self._arenas or \
+                len(self._arenas[-1]) + length > _ARENA_SIZE:
+            self._arenas.append(bytearray())
+        arena = self._arenas[-1]
+        offset = len(arena)
+        arena.extend(value)
+        self._used += length
+        return len(self._arenas) - 1, offset
+ 
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+# Files dbm.dumb keeps the database in
+_DUMB_EXTS = (".dat", ".dir", ".bak")
+
 class DumbDb:
     def __init__(self, path):
-        self._db = dbm.dumb.open(path, 'c')
+        # ndbm has serious problems with large number od keys
+        import dbm.dumb
+        self._dumb = dbm.dumb
+        self._path = path
+        self._db = self._dumb.open(path, 'c')
 
     def __setitem__(self, key, value):
         self._db[key] = value
 
+    def __delitem__(self, key):
+        del self._db[key]
+
     def __getitem__(self, key):
         return self._db[key]
 
@@ -70,6 +321,36 @@ class DumbDb:
         for key in self._db.keys():
             yield key, self._db[key]
 
+    def keys(self):
+        return self._db.keys()
+
+    def range(self, start=None, stop=None):
+        keys = sorted(k for k in self._db.keys() if _in_range(k, start, stop))
+        for key in keys:
+            yield key, self._db[key]
+
+    def prefix(self, prefix):
+        return self.range(prefix, prefix_end(prefix))
+
+    def compact(self, drop=()):
+        """dbm.dumb never reuses space of deleted or overwritten values, 
+           copy live ones (except keys in drop) into a fresh database instead"""
+        drop = set(drop)
+        compact_path = self._path + ".compact"
+        compacted = self._dumb.open(compact_path, 'n')
+        try:
+            for key in self._db.keys():
+                if key not in drop: compacted[key] = self._db[key]
+        finally:
+            compacted.close()
+        self._db.close()
+        for ext in _DUMB_EXTS:
+            if os.path.exists(compact_path + ext):
+                os.replace(compact_path + ext, self._path + ext)
+            elif os.path.exists(self._path + ext):
+                os.unlink(self._path + ext)
+        self._db = self._dumb.open(self._path, 'c')
+
     def close(self):
         self._db.close()
  
@@ -77,8 +358,12 @@ class DumbDb:
     def __exit__(self, type, value, traceback): self.close()
 
 _BACKENDS["memory"]=InMemoryDb
+_BACKENDS["packed"]=PackedDb
 _BACKENDS["dumb"]=DumbDb
 
+# Backends which keep data in this process only
+_IN_PROCESS = ("memory", "packed")
+
 DEFAULT_BACKEND="dumb"
 
 def open(path, backend=DEFAULT_BACKEND):
@@ -87,3 +372,12 @@ def open(path, backend=DEFAULT_BACKEND):
     return bak(path)
 
 def backends(): return list(_BACKENDS.keys())
+
+def exists(path):
+    "Whether any of the persistent backends has a database at path"
+    return os.path.exists(path) or \
+        any(os.path.exists(path + ext) for ext in _DUMB_EXTS)
+
+def persistent(backend):
+    "Whether backend keeps data in files other processes can open"
+    return backend not in _IN_PROCESS
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import keyvalue
+import os
+import shutil
+import tempfile
+import unittest
+
+class DumbDbTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "db")
+        self.fixture = keyvalue.DumbDb(self.path)
+
+    def tearDown(self):
+        self.fixture.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_compact(self):
+        for i in range(100):
+            self.fixture[bytes((i,))] = bytes((i,)) * 100
+        for i in range(0, 100, 2):
+            del self.fixture[bytes((i,))]
+        size = os.path.getsize(self.path + ".dat")
+        self.fixture.compact()
+        self.assertTrue(os.path.getsize(self.path + ".dat") < size)
+        self.assertEqual([(bytes((i,)), bytes((i,)) * 100) 
+            for i in range(1, 100, 2)], list(self.fixture.range()))
+        self.fixture[b'new'] = b'value'
+        self.assertEqual(b'value', self.fixture[b'new'])
+
+    def test_compact_drops_keys(self):
+        for i in range(10):
+            self.fixture[bytes((i,))] = b'value'
+        self.fixture.compact(drop=[bytes((i,)) for i in range(0, 10, 2)])
+        self.assertEqual([bytes((i,)) for i in range(1, 10, 2)], 
+            [key for key, _ in self.fixture.range()])
+
+class BPlusTreeDbTest(DumbDbTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "db")
+        self.fixture = keyvalue.BPlusTreeDb(self.path)
+
+    def test_compact(self):
+        for i in range(1000):
+            self.fixture[bytes((i % 256, i // 256))] = b'value' * 10
+        self.fixture.compact(drop=[bytes((i % 256, i // 256)) 
+            for i in range(0, 1000, 2)])
+        self.assertEqual(500, len(list(self.fixture.range())))
+        self.assertIsNone(self.fixture.get(b'\x00\x00'))
+        self.assertEqual(b'value' * 10, self.fixture[b'\x01\x00'])
+
+class PackedDbTest(unittest.TestCase):
+    def setUp(self):
+        self.fixture = keyvalue.PackedDb('', budget=100)
+
+    def tearDown(self):
+        self.fixture.close()
+
+    def test_set_get(self):
+        self.fixture[b'01'] = b'value1'
+        self.fixture[b'02'] = b''
+        self.assertEqual(b'value1', self.fixture[b'01'])
+        self.assertEqual(b'', self.fixture.get(b'02'))
+        self.assertIsNone(self.fixture.get(b'03'))
+        self.assertRaises(KeyError, lambda: self.fixture[b'03'])
+
+    def test_overwrite_and_delete(self):
+        self.fixture[b'01'] = b'value1'
+        self.fixture[b'01'] = b'value2'
+        self.fixture[b'02'] = b'value3'
+        del self.fixture[b'02']
+        self.fixture[b'03'] = b'value4'
+        self.assertEqual(b'value2', self.fixture[b'01'])
+        self.assertIsNone(self.fixture.get(b'02'))
+        self.assertEqual(b'value4', self.fixture[b'03'])
+
+    def test_spills_over_budget(self):
+        for i in range(100):
+            self.fixture[bytes((i,))] = bytes((i,)) * 10
+        self.assertTrue(self.fixture._spill)
+        for i in range(100):
+            self.assertEqual(bytes((i,)) * 10, self.fixture[bytes((i,))])
+
+    def test_overwrite_and_delete_return_budget(self):
+        for i in range(100):
+            self.fixture[b'01'] = bytes((i,)) * 10
+            self.fixture[b'02'] = b'x' * 10
+            del self.fixture[b'02']
+        self.assertFalse(self.fixture._spill)
+        self.assertEqual(bytes((99,)) * 10, self.fixture[b'01'])
+
+    def test_overwrites_do_not_grow_arenas(self):
+        self.fixture.close()
+        self.fixture = keyvalue.PackedDb('', budget=1000)
+        for i in range(10000):
+            self.fixture[b'01'] = bytes((i % 256,)) * 500
+        self.assertTrue(
+            sum(len(arena) for arena in self.fixture._arenas) <= 1000)
+        self.assertFalse(self.fixture._spill)
+        self.assertEqual(bytes((9999 % 256,)) * 500, self.fixture[b'01'])
+
+    def test_compact_brings_spilled_back(self):
+        for i in range(20):
+            self.fixture[bytes((i,))] = bytes((i,)) * 10
+        self.assertTrue(self.fixture._spill)
+        for i in range(10):
+            del self.fixture[bytes((i,))]
+        self.fixture.compact()
+        self.assertFalse(self.fixture._spill)
+        self.assertEqual([(bytes((i,)), bytes((i,)) * 10) 
+            for i in range(10, 20)], list(self.fixture.range()))
+
+    def test_range_and_compact(self):
+        for i in range(100):
+            self.fixture[bytes((i,))] = bytes((i,)) * 10
+        for i in range(0, 100, 2):
+            del self.fixture[bytes((i,))]
+        self.fixture.compact()
+        got = list(self.fixture.range(b'\x10', b'\x20'))
+        self.assertEqual([(bytes((i,)), bytes((i,)) * 10) 
+            for i in range(0x11, 0x20, 2)], got)
+
+    def test_close_releases_data(self):
+        self.fixture[b'01'] = b'value1'
+        self.fixture.close()
+        self.assertTrue(self.fixture.closed)
+        self.assertIsNone(self.fixture.get(b'01'))
+
+if __name__ == '__main__':
+    unittest.main()
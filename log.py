@@ -1,7 +1,6 @@
 # -*- coding: UTF-8 -*-
-"Thin layer over std python logging"
-
-import logging
+"""Thin layer over std python logging. logging itself is imported on first 
+use of a logger"""
 
 class _Config:
     def __init__(self):
@@ -10,13 +9,22 @@ class _Config:
 _CONFIG = _Config()
 
 def config(werror = False, log_level = "INFO"):
+    import logging
     _CONFIG.warnings_as_errors = werror
     logging.basicConfig(level=getattr(logging, log_level))
 
 
 class WarningsInterceptor:
-    def __init__(self, reallog):
-        self._reallog = reallog
+    def __init__(self, name):
+        self._name = name
+        self._logger = None
+
+    @property
+    def _reallog(self):
+        if self._logger is None:
+            import logging
+            self._logger = logging.getLogger(self._name)
+        return self._logger
 
     def warning(self, msg, *args, **kwargs):
         self._reallog.warning(msg, *args, **kwargs)
@@ -41,4 +49,4 @@ class WarningsInterceptor:
     def __getattr__(self, attr):
         return getattr(self._reallog, attr)
 
-def get(name): return WarningsInterceptor(logging.getLogger(name))
+def get(name): return WarningsInterceptor(name)
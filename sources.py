@@ -1,30 +1,76 @@
 # -*- coding: UTF-8 -*-
-"""Abstract view of the files as sources. Eventually will allow 
-reading files from .zip and .gz archives
+"""Abstract view of the files as sources. Allows reading files from .zip
+archives and from .gz, .bz2 and .xz compressed files
+
+Plain files are read once from start to end, so where os.posix_fadvise is
+available, the kernel is told so: reads are advised SEQUENTIAL, files to be
+read soon may be advised WILLNEED by will_need(), and pages of a file are
+dropped (DONTNEED) when it is closed, so a large scan does not evict pages
+other processes (and our indexes) use.
 """
 
+import bz2
+import gzip
+import io
+import lzma
 import os
 import os.path
+import shutil
+import tempfile
 import zipfile
 import datetime
 
+# Archives inside archives are copied into a spooled buffer so zipfile can
+# seek in them. Small ones stay in memory, larger ones spill to disk
+_SPOOL_MAX_SIZE = 64*1024*1024
+_COPY_BUFFER_SIZE = 1024*1024
+
 def source_at(path, recursive=True):
     """Return either a Source (if path is pointing to a file) or 
        Sources (if path is pointing to a directory or .zip. Or None if
        path does not point to file or directory"""
     if os.path.isfile(path):
         if recursive and _looks_like_zip(path):
-            stream = open(path, "rb")
-            unpacked = _attempt_open_zip(stream)
-            if unpacked:
-                return ZipFileListing(path, unpacked)
+            listing = open_zip(path)
+            if listing: return listing
+        opener = _compression_opener(path)
+        if opener:
+            return CompressedFileSource(path, opener)
         return FileSource(path)
     elif os.path.isdir(path):
         return DirectorySources(path, recursive)
 
+def exists(path):
+    """Check whether the source at path still exists. For files inside
+       archives only the outermost archive is checked"""
+    archive, _, _ = path.partition("!/")
+    return os.path.exists(archive)
+
 def _looks_like_zip(path):
+    return _ext(path) == ".zip"
+
+# Single-file compressions which are decompressed on the fly
+_COMPRESSIONS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open
+}
+
+def _compression_opener(path):
+    return _COMPRESSIONS.get(_ext(path))
+
+def _ext(path):
     _, ext = os.path.splitext(path)
-    return ext.strip().lower() == ".zip"
+    return ext.strip().lower()
+
+def open_zip(path, names=None):
+    """Open .zip at path and return ZipFileListing (optionally limited to
+       names) or None if path is not a zip. Each call opens its own ZipFile,
+       so listings returned by separate calls can be read concurrently"""
+    stream = open(path, "rb")
+    unpacked = _attempt_open_zip(stream)
+    if unpacked:
+        return ZipFileListing(path, unpacked, names, stream=stream)
 
 def _attempt_open_zip(stream):
     """Attempts opening a stream using zip. If attempt fails, the stream
@@ -67,15 +113,52 @@ class Source:
         "Returns modification time of this source in seconds"
 
     def size(self):
-        "Returns size of this source in bytes"
+        """Returns size of this source in bytes or None if size is not 
+           known until the source is read"""
+
+    def ext(self):
+        "Returns lowercase extension of the contents (for ex, '.fb2')"
+        return _ext(self.path())
 
     def open(self, mode):
         """Return file-like object that can be read from. It has to be
            closed after it is no longer in use"""
         pass
 
+    def will_need(self):
+        "Hint that the source is going to be read soon"
+        pass
+
     def __str__(self): return self.path()
 
+class PrefetchedSource(Source):
+    """Source which contents were read into memory in advance, by prefetch().
+       Path, mtime, size and ext are those of the original source"""
+
+    def __init__(self, src, data):
+        self._src = src
+        self._data = data
+
+    def path(self): return self._src.path()
+
+    def mtime(self): return self._src.mtime()
+
+    def size(self): return self._src.size()
+
+    def ext(self): return self._src.ext()
+
+    def open(self, mode): return io.BytesIO(self._data)
+
+def prefetch(src, accept=None, head_len=4096):
+    """Read whole src into memory, return PrefetchedSource. If accept is 
+       given, it is called with the first head_len bytes and None is returned
+       without reading the rest if it returns False"""
+    with src.open("rb") as stream:
+        if not accept: return PrefetchedSource(src, stream.read())
+        head = stream.read(head_len)
+        if not accept(head): return None
+        return PrefetchedSource(src, head + stream.read())
+
 class DirectorySources(Sources):
     """Represents a directory as a source of files"""
 
@@ -99,10 +182,45 @@ class DirectorySources(Sources):
             elif self._recursive and self._isdir(fullname):
                 yield DirectorySources(fullname, True)
 
+_FADVISE = hasattr(os, "posix_fadvise")
+
+def _advise(fd, advice):
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass # advice is optional, some filesystems do not support it
+
+def _will_need(path):
+    if not _FADVISE: return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        _advise(fd, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+class _SequentialFile(io.FileIO):
+    """Unbuffered binary file, read sequentially once. Its pages are dropped
+       from page cache on close"""
+
+    def __init__(self, path):
+        io.FileIO.__init__(self, path, "rb")
+        _advise(self.fileno(), os.POSIX_FADV_SEQUENTIAL)
+
+    def close(self):
+        if not self.closed: _advise(self.fileno(), os.POSIX_FADV_DONTNEED)
+        io.FileIO.close(self)
+
+def _open_sequential(path, mode):
+    if _FADVISE and mode == "rb": return _SequentialFile(path)
+    return open(path, mode)
+
 class FileSource(Source):
     def __init__(self, path):
         self._path = path
-        self._open = open
+        self._open = _open_sequential
         self._stat = os.stat(path)
 
     def path(self): return self._path
@@ -113,22 +231,89 @@ class FileSource(Source):
 
     def open(self, mode): return self._open(self._path, mode)
 
+    def will_need(self): _will_need(self._path)
 
-class ZipFileListing(Sources):
-    """Represents contents of the .zip file"""
+class CompressedFileSource(Source):
+    """Represents a compressed file (for ex, book.fb2.gz). Contents are 
+       decompressed while reading"""
 
-    def __init__(self, path, zip_file):
+    def __init__(self, path, opener):
+        self._path = path
+        self._opener = opener
+        self._stat = os.stat(path)
+
+    def path(self): return self._path
+
+    def mtime(self): return self._stat.st_mtime
+
+    def size(self): return None
+
+    def ext(self):
+        without_compression, _ = os.path.splitext(self._path)
+        return _ext(without_compression)
+
+    def open(self, mode):
+        if "w" in mode:
+            raise ValueError("So far, compressed files are treated readonly")
+        return self._opener(self._path, "rb")
+
+    def will_need(self): _will_need(self._path)
+
+class ZipFileListing(Sources):
+    """Represents contents of the .zip file. Archives found inside are 
+       listed as nested ZipFileListings when recursive"""
+
+    def __init__(self, path, zip_file, names=None, recursive=True, 
+                       stream=None, nested=False):
+        """@param names If given, only these members are listed (used to
+                  split large archives between workers)
+           @param stream The stream zip_file reads from, closed together
+                  with this listing
+           @param nested True if this is an archive inside another one"""
         self._path = path
         self._zip = zip_file
+        self._names = names
+        self._recursive = recursive
+        self._stream = stream
+        self._nested = nested
 
-    def close(self): self._zip.close()
+    def close(self): 
+        self._zip.close()
+        if self._stream: self._stream.close()
 
     def path(self): return self._path
 
+    def reopenable(self):
+        "True if open_zip(self.path()) would open this very archive again"
+        return not self._nested
+
+    def namelist(self):
+        "Return names of the members this listing covers"
+        if self._names is None:
+            return self._zip.namelist()
+        else:
+            return list(self._names)
+
     def sources(self):
-        for name in self._zip.namelist():
+        for name in self.namelist():
             fullname = _zip_join(self._path, name)
-            yield ZipFileSource(fullname, self._zip, name)
+            nested = None
+            if self._recursive and _looks_like_zip(name):
+                nested = self._open_nested(fullname, name)
+            if nested:
+                yield nested
+            else:
+                yield ZipFileSource(fullname, self._zip, name)
+
+    def _open_nested(self, fullname, name):
+        spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+        with self._zip.open(name, "r") as member:
+            shutil.copyfileobj(member, spool, _COPY_BUFFER_SIZE)
+        spool.seek(0)
+        unpacked = _attempt_open_zip(spool)
+        if unpacked:
+            return ZipFileListing(fullname, unpacked, stream=spool, 
+                nested=True)
 
 def _zip_join(zipname, name): return zipname + "!/" + name
 
@@ -3,8 +3,10 @@
 
 import sources
 
+import gzip
 import io
 import os.path
+import tempfile
 import zipfile
 import unittest
 
@@ -19,6 +21,16 @@ class FileSourceTest(unittest.TestCase):
         self.fs._open = lambda path, mode: path+':'+mode
         self.assertEqual("/some/path:wb", self.fs.open("wb"))
 
+class SequentialReadTest(unittest.TestCase):
+    def test_read(self):
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(b"content")
+            tmp.flush()
+            fs = sources.FileSource(tmp.name)
+            fs.will_need()
+            with fs.open("rb") as f:
+                self.assertEqual(b"content", f.read())
+
 class DirectorySourcesTest(unittest.TestCase):
     def setUp(self):
         self.ds = sources.DirectorySources("/some/path/")
@@ -82,5 +94,89 @@ class ZipTest(unittest.TestCase):
                 self.assertEqual("file1.zip!/file2.txt", file2.path())
                 self.assertEqual(b'some text', file2.open("r").read())
 
+    def test_names_limit_listing(self):
+        inmem = io.BytesIO()
+        with zipfile.ZipFile(inmem, "w") as file1:
+            for name in ("a.txt", "b.txt", "c.txt"):
+                with file1.open(name, "w") as stream:
+                    stream.write(name.encode())
+
+        with zipfile.ZipFile(io.BytesIO(inmem.getbuffer())) as zip1:
+            with sources.ZipFileListing("file1.zip", zip1, ["c.txt"]) as lst:
+                self.assertEqual(["c.txt"], lst.namelist())
+                srcs = list(lst.sources())
+                self.assertEqual(1, len(srcs))
+                self.assertEqual("file1.zip!/c.txt", srcs[0].path())
+
+class NestedZipTest(unittest.TestCase):
+    def make_zip(self, files):
+        inmem = io.BytesIO()
+        with zipfile.ZipFile(inmem, "w") as zip_file:
+            for name, data in files.items():
+                zip_file.writestr(name, data)
+        return inmem.getvalue()
+
+    def test_zip_inside_zip(self):
+        inner = self.make_zip({"book.fb2": b"some text"})
+        outer = self.make_zip({"inner.zip": inner})
+        with zipfile.ZipFile(io.BytesIO(outer)) as zip1:
+            with sources.ZipFileListing("outer.zip", zip1) as listing:
+                srcs = list(listing.sources())
+                self.assertEqual(1, len(srcs))
+                nested = srcs[0]
+                self.assertTrue(isinstance(nested, sources.ZipFileListing))
+                with nested:
+                    self.assertFalse(nested.reopenable())
+                    self.assertEqual("outer.zip!/inner.zip", nested.path())
+                    books = list(nested.sources())
+                    self.assertEqual("outer.zip!/inner.zip!/book.fb2",
+                        books[0].path())
+                    self.assertEqual(b"some text", books[0].open("r").read())
+
+    def test_not_recursive(self):
+        inner = self.make_zip({"book.fb2": b"some text"})
+        outer = self.make_zip({"inner.zip": inner})
+        with zipfile.ZipFile(io.BytesIO(outer)) as zip1:
+            with sources.ZipFileListing("outer.zip", zip1, 
+                    recursive=False) as listing:
+                srcs = list(listing.sources())
+                self.assertTrue(isinstance(srcs[0], sources.ZipFileSource))
+
+    def test_broken_inner_zip_is_a_plain_source(self):
+        outer = self.make_zip({"inner.zip": b"not a zip"})
+        with zipfile.ZipFile(io.BytesIO(outer)) as zip1:
+            with sources.ZipFileListing("outer.zip", zip1) as listing:
+                srcs = list(listing.sources())
+                self.assertTrue(isinstance(srcs[0], sources.ZipFileSource))
+
+class CompressedFileSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_gz(self):
+        path = os.path.join(self.dir.name, "book.fb2.gz")
+        with gzip.open(path, "wb") as stream:
+            stream.write(b"some text")
+        src = sources.source_at(path)
+        self.assertTrue(isinstance(src, sources.CompressedFileSource))
+        self.assertEqual(path, src.path())
+        self.assertEqual(".fb2", src.ext())
+        self.assertEqual(None, src.size())
+        with src.open("rb") as stream:
+            buffer = bytearray(100)
+            self.assertEqual(9, stream.readinto(buffer))
+            self.assertEqual(b"some text", buffer[:9])
+
+    def test_plain_file_ext(self):
+        path = os.path.join(self.dir.name, "book.FB2")
+        with open(path, "wb") as stream:
+            stream.write(b"some text")
+        src = sources.source_at(path)
+        self.assertTrue(isinstance(src, sources.FileSource))
+        self.assertEqual(".fb2", src.ext())
+
 if __name__ == '__main__':
     unittest.main()
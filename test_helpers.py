@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"Helpers shared by *_test.py modules"
+
+import keyvalue
+
+class KeptDb(keyvalue.InMemoryDb):
+    "In-memory DB which keeps data after close(), as if it was on disk"
+    def close(self): self.closed = True
@@ -0,0 +1,236 @@
+# -*- coding: UTF-8 -*-
+"""Watchers report files which appeared or changed in a set of directories,
+so only those are parsed instead of rescanning everything.
+
+Every watcher has changes(timeout) which waits up to timeout seconds and
+returns a list of paths ready to be parsed, and close(). Files which exist
+when the watcher is created are considered known.
+
+* poll - portable, rescans directories with os.scandir and compares mtime
+  and size. A file is reported once its mtime and size did not change
+  between two scans, so files still being copied are not picked up.
+* inotify - Linux only (via ctypes), reports files once they are closed
+  after writing or moved into a watched directory. If the kernel queue
+  overflows and events are lost, directories are rescanned once and files
+  which changed since they were last known are reported.
+"""
+
+import log
+import os
+import os.path
+import time
+
+_LOGGER = log.get("bookdesc.watch")
+
+DEFAULT_INTERVAL = 5.0 # seconds between scans of poll watcher
+
+def _scan(directory, result):
+    "Collect {path: (mtime_ns, size)} of all files under directory"
+    try:
+        entries = list(os.scandir(directory))
+    except OSError as error:
+        _LOGGER.warning("Can't scan %s: %s", directory, error)
+        return result
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                _scan(entry.path, result)
+            elif entry.is_file():
+                stat = entry.stat()
+                result[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass # removed while scanning
+    return result
+
+def _scan_all(dirs):
+    "Collect {path: (mtime_ns, size)} of all files under all dirs"
+    result = {}
+    for directory in dirs:
+        _scan(directory, result)
+    return result
+
+class PollingWatcher:
+    def __init__(self, dirs, interval=DEFAULT_INTERVAL):
+        self._dirs = list(dirs)
+        self._interval = interval
+        self._seen = self._scan_all()
+        self._reported = dict(self._seen)
+        self._next_scan = time.monotonic() + interval
+
+    def changes(self, timeout=None):
+        """Wait for the next scan (but no longer than timeout), return files
+           which changed and are stable since the previous scan"""
+        delay = self._next_scan - time.monotonic()
+        if timeout is not None and delay > timeout:
+            time.sleep(max(0, timeout))
+            return []
+        if delay > 0: time.sleep(delay)
+        self._next_scan = time.monotonic() + self._interval
+        return self.poll()
+
+    def poll(self):
+        "Scan directories now, return stable changed files"
+        current = self._scan_all()
+        changed = []
+        for path, stat in current.items():
+            if stat == self._seen.get(path) and \
+                    stat != self._reported.get(path):
+                changed.append(path)
+                self._reported[path] = stat
+        for path in set(self._reported) - set(current):
+            del self._reported[path]
+        self._seen = current
+        return sorted(changed)
+
+    def close(self): pass
+
+    def _scan_all(self): return _scan_all(self._dirs)
+
+# inotify(7) constants
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+_EVENT_HEADER = "iIII" # wd, mask, cookie, len
+
+def _libc():
+    "libc with inotify functions or None"
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+            use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class InotifyWatcher:
+    def __init__(self, dirs, interval=None):
+        "interval is ignored, events arrive as they happen"
+        import struct
+        self._struct = struct.Struct(_EVENT_HEADER)
+        self._libc = _libc()
+        if not self._libc: raise OSError("inotify is not available")
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0: self._raise()
+        self._dirs = {} # watch descriptor -> directory
+        self._roots = list(dirs)
+        for directory in self._roots:
+            self._add_tree(directory)
+        self._known = _scan_all(self._roots) # see _rescan()
+
+    def changes(self, timeout=None):
+        "Wait for events up to timeout, return files written or moved in"
+        import select
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable: return []
+        changed = []
+        overflow = False
+        data = self._read()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._struct.unpack_from(data, offset)
+            offset += self._struct.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & _IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name: continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    # files may be there before the watch is added
+                    self._add_tree(path)
+                    changed.extend(_scan(path, {}).keys())
+            elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                changed.append(path)
+        if overflow:
+            _LOGGER.warning("inotify queue overflow, rescanning %s", 
+                ", ".join(self._roots))
+            changed.extend(self._rescan())
+        else:
+            self._remember(changed)
+        return sorted(set(changed))
+
+    def _rescan(self):
+        """Watch folders created while events were lost, return files which
+           changed since they were last known"""
+        for directory in self._roots:
+            self._add_tree(directory)
+        current = _scan_all(self._roots)
+        changed = [path for path, stat in current.items() 
+            if stat != self._known.get(path)]
+        self._known = current
+        return changed
+
+    def _remember(self, paths):
+        "Keep stat of reported paths, so _rescan() does not report them again"
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                self._known[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                self._known.pop(path, None)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _read(self):
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self._fd, 64*1024)
+            except BlockingIOError:
+                break
+            if not chunk: break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def _add_tree(self, directory):
+        self._add(directory)
+        for root, dirs, _ in os.walk(directory):
+            for name in dirs:
+                self._add(os.path.join(root, name))
+
+    def _add(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory),
+            _WATCH_MASK)
+        if wd < 0:
+            _LOGGER.warning("Can't watch %s", directory)
+        else:
+            self._dirs[wd] = directory
+
+    def _raise(self):
+        import ctypes
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+_WATCHERS = {
+    "poll": PollingWatcher,
+    "inotify": InotifyWatcher
+}
+
+def watchers(): return ["auto"] + list(_WATCHERS.keys())
+
+def open(dirs, kind="auto", interval=DEFAULT_INTERVAL):
+    "Create watcher of given kind, auto means inotify if available"
+    if kind == "auto":
+        kind = "inotify" if _libc() else "poll"
+    watcher = _WATCHERS.get(kind)
+    if not watcher: raise ValueError("Watcher " + kind + " is unavailable")
+    _LOGGER.info("Watching %s with %s watcher", ", ".join(dirs), kind)
+    return watcher(dirs, interval)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import watch
+
+class PollingWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.write("old.fb2", b'old')
+        self.fixture = watch.PollingWatcher([self.tmpdir], interval=0)
+
+    def tearDown(self):
+        self.fixture.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_existing_files_are_known(self):
+        self.assertEqual([], self.fixture.poll())
+        self.assertEqual([], self.fixture.poll())
+
+    def test_new_file_is_reported_once_stable(self):
+        path = self.write("sub/new.fb2", b'n')
+        self.assertEqual([], self.fixture.poll())
+        self.write("sub/new.fb2", b'ne') # still being written
+        self.assertEqual([], self.fixture.poll())
+        self.assertEqual([path], self.fixture.poll())
+        self.assertEqual([], self.fixture.poll())
+
+    def test_changed_file_is_reported(self):
+        path = self.write("old.fb2", b'changed')
+        self.fixture.poll()
+        self.assertEqual([path], self.fixture.poll())
+
+    def test_changes(self):
+        path = self.write("new.fb2", b'new')
+        self.fixture.changes()
+        self.assertEqual([path], self.fixture.changes())
+
+@unittest.skipUnless(watch._libc(), "inotify is not available")
+class InotifyWatcherTest(PollingWatcherTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.write("old.fb2", b'old')
+        self.fixture = watch.InotifyWatcher([self.tmpdir])
+
+    def test_existing_files_are_known(self):
+        self.assertEqual([], self.fixture.changes(0))
+
+    def test_new_file_is_reported_once_stable(self):
+        os.mkdir(os.path.join(self.tmpdir, "sub"))
+        self.assertEqual([], self.fixture.changes(0.1))
+        path = self.write("sub/new.fb2", b'n')
+        self.assertEqual([path], self.fixture.changes(1))
+        self.assertEqual([], self.fixture.changes(0))
+
+    def test_changed_file_is_reported(self):
+        path = self.write("old.fb2", b'changed')
+        self.assertEqual([path], self.fixture.changes(1))
+
+    def test_changes(self):
+        path = self.write("new.fb2", b'new')
+        self.assertEqual([path], self.fixture.changes(1))
+
+    def test_new_folder_is_scanned(self):
+        sub = os.path.join(self.tmpdir, "sub")
+        os.mkdir(sub)
+        path = self.write("sub/new.fb2", b'n')
+        changed = []
+        for _ in range(3): changed.extend(self.fixture.changes(0.2))
+        self.assertEqual([path], sorted(set(changed)))
+
+    def test_overflow_rescans(self):
+        # feed the watcher a queue overflow instead of the real events
+        os.close(self.fixture._fd)
+        read, write = os.pipe()
+        os.set_blocking(read, False)
+        self.fixture._fd = read
+        old = self.write("old.fb2", b'changed')
+        new = self.write("sub/new.fb2", b'n')
+        os.write(write, struct.pack(watch._EVENT_HEADER, -1, 
+            watch._IN_Q_OVERFLOW, 0, 0))
+        os.close(write)
+        self.assertEqual(sorted([old, new]), self.fixture.changes(1))
+
+if __name__ == '__main__':
+    unittest.main()